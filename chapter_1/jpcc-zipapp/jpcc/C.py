@@ -2,6 +2,11 @@
 # See "Writing a C Compiler" by Nora Sandler.
 
 import sys
+import os
+import hashlib
+import pickle
+import tempfile
+import threading
 from dataclasses import dataclass
 
 try:
@@ -27,29 +32,29 @@ except:
 #    Constant : Constant(value: int)
 
 
-class C_AST: pass
+class C_AST: __slots__ = ()
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class Constant(C_AST):
     value: int
 
 
-class Statement(C_AST): pass
+class Statement(C_AST): __slots__ = ()
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class Return(Statement):
     expr: Constant
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class Function(C_AST):
     name: str
     body: Return
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class Program(C_AST):
     funcdef: Function
 
@@ -94,9 +99,24 @@ class Program(C_AST):
 #   )
 
 
-def _c_pycp_ast(fname: str) -> pycparser.c_ast.Node:
-    "Use pycparser to parse a C file, returning the AST."
-    c_ast = pycparser.parse_file(fname, use_cpp=False)
+_thread_local = threading.local()
+
+def _get_parser() -> pycparser.CParser:
+    "Return this thread's pycparser parser, creating it on first use."
+    # note: pycparser.parse_file() constructs a new CParser (and reloads its
+    # lexer and LALR tables) on every call, so we hold on to one.
+    # note: a CParser keeps its parse state on itself, so it isn't safe to
+    # share between threads (remote compiles run on a thread pool).
+    parser = getattr(_thread_local, "parser", None)
+    if parser is None:
+        parser = pycparser.CParser()
+        _thread_local.parser = parser
+    return parser
+
+
+def _c_pycp_ast(fname: str, text: str) -> pycparser.c_ast.Node:
+    "Use pycparser to parse the text of a C file, returning the AST."
+    c_ast = _get_parser().parse(text, fname)
     return c_ast
 
 
@@ -116,7 +136,7 @@ def _pycp_ast_to_ch1_ast(c_ast: pycparser.c_ast.Node) -> C_AST:
 
     ch1_ast = Program(
         Function(
-            name = funcdef.decl.name,
+            name = sys.intern(funcdef.decl.name),
             body = Return(
                 Constant(constant.value)
             )
@@ -126,8 +146,90 @@ def _pycp_ast_to_ch1_ast(c_ast: pycparser.c_ast.Node) -> C_AST:
     return ch1_ast
 
 
+# Parsed ASTs are cached (in memory, and pickled to disk) keyed by a hash of
+# the source text, so re-compiling an unchanged file skips pycparser entirely.
+# The key also covers our own code, and the pycparser and python versions,
+# so that changing the translator, the AST classes, or upgrading either of
+# those invalidates any stale entries.
+
+_ast_cache = {}
+_code_digest = None
+
+
+def _cache_dir() -> str:
+    "Return the on-disk AST cache directory, or None if disabled."
+    if "JPCC_CACHE_DIR" in os.environ:
+        return os.environ["JPCC_CACHE_DIR"] or None
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(cache_home, "jpcc")
+
+
+def _versions() -> bytes:
+    "Return the versions of pycparser and python, which also key the cache."
+    # note: pickles of our (slotted) AST classes are sensitive to the python
+    # version, and a pycparser upgrade may parse the same source differently.
+    return f"{pycparser.__version__} {sys.version_info[:2]}".encode()
+
+
+def _cache_key(data: bytes) -> str:
+    "Return the cache key for the given C source."
+    global _code_digest
+    if _code_digest is None:
+        h = hashlib.blake2b(digest_size=16)
+        h.update(__loader__.get_data(__file__))
+        h.update(_versions())
+        _code_digest = h.digest()
+    h = hashlib.blake2b(_code_digest, digest_size=16)
+    h.update(data)
+    return h.hexdigest()
+
+
+def _cache_load(key: str) -> C_AST:
+    "Load a cached AST from disk, returning None on a cache miss."
+    cache_dir = _cache_dir()
+    if cache_dir is None:
+        return None
+    try:
+        with open(os.path.join(cache_dir, key + ".pickle"), "rb") as fd:
+            return pickle.load(fd)
+    except Exception:
+        return None
+
+
+def _cache_store(key: str, ast: C_AST) -> None:
+    "Store an AST in the on-disk cache (best effort)."
+    cache_dir = _cache_dir()
+    if cache_dir is None:
+        return
+    tmp_fname = None
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        # write to a temp file and rename, so that concurrent compiles never
+        # observe a partially-written entry.
+        (fd, tmp_fname) = tempfile.mkstemp(dir=cache_dir)
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(ast, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_fname, os.path.join(cache_dir, key + ".pickle"))
+    except Exception:
+        # don't leave the temp file behind in the cache dir.
+        if tmp_fname is not None:
+            try:
+                os.unlink(tmp_fname)
+            except OSError:
+                pass
+
+
 def parse(fname: str) -> C_AST:
     "Parse a C file and return the chapter 1 C AST."
-    pycp_ast = _c_pycp_ast(fname)
-    ch1_ast = _pycp_ast_to_ch1_ast(pycp_ast)
+    with open(fname, "rb") as fd:
+        data = fd.read()
+    key = _cache_key(data)
+    ch1_ast = _ast_cache.get(key)
+    if ch1_ast is None:
+        ch1_ast = _cache_load(key)
+    if ch1_ast is None:
+        pycp_ast = _c_pycp_ast(fname, data.decode())
+        ch1_ast = _pycp_ast_to_ch1_ast(pycp_ast)
+        _cache_store(key, ch1_ast)
+    _ast_cache[key] = ch1_ast
     return ch1_ast
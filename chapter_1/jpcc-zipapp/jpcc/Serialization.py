@@ -1,5 +1,8 @@
 # This file implements a simple symbolic expression serialization format.
 
+import json
+from enum import Enum
+
 def to_exprs_str(obj, pretty=True, indent=4):
     """Serialize the object as symbolic expressions (lists).
     The first item in each list is the type of the object.
@@ -20,73 +23,87 @@ def to_exprs_str(obj, pretty=True, indent=4):
             props (dict "b" 2) bar (Bar enabled True))
     """
 
-    def to_exprs(obj):
-        "Recursively convert the object into lists."
+    def properties(obj) -> dict:
+        "Return the properties of an object, including those stored in slots."
+        props = {}
+        for name in _get_slot_names(type(obj)):
+            value = getattr(obj, name, _missing)
+            if value is not _missing:
+                props[name] = value
+        props.update(getattr(obj, '__dict__', {}))
+        return props
+
+    # note: rather than first converting the object into nested lists and
+    # then formatting those, we emit string fragments directly into a list,
+    # which is joined once at the end.
+    def emit(obj, out: list[str], _level=0) -> None:
+        "Recursively serialize the object, appending fragments to out."
         if isinstance(obj, (type(None), bool, int, float)):
-            return obj
+            out.append(f"{obj}")
         elif isinstance(obj, str):
-            return f'"{obj}"'
+            # note: json.dumps() escapes any embedded quotes and backslashes.
+            out.append(json.dumps(obj))
+        elif isinstance(obj, Enum):
+            # enum members serialize as an empty object named for the member.
+            out += ["(", obj.name, ")"]
         elif isinstance(obj, (tuple, list, set)):
-            exprs = [obj.__class__.__name__] + [to_exprs(x) for x in obj]
-            return exprs
-        elif hasattr(obj, 'items') or hasattr(obj, '__dict__'):
-            exprs = [obj.__class__.__name__]
-            pairs = (obj.__dict__ if hasattr(obj, '__dict__') else obj).items()
+            out += ["(", obj.__class__.__name__]
+            if pretty:
+                lead = (" " * indent) * _level
+                lead2 = lead + (" " * indent)
+                for x in obj:
+                    out += ["\n", lead2]
+                    emit(x, out, _level+1)
+                out += ["\n", lead, ")"]
+            else:
+                for x in obj:
+                    out.append(" ")
+                    emit(x, out, _level+1)
+                out.append(")")
+        elif hasattr(obj, 'items') or hasattr(obj, '__dict__') or hasattr(obj, '__slots__'):
+            out += ["(", obj.__class__.__name__]
+            is_object = hasattr(obj, '__dict__') or hasattr(obj, '__slots__')
+            pairs = (properties(obj) if is_object else obj).items()
+            lead = (" " * indent) * _level
+            lead2 = lead + (" " * indent)
+            is_empty = True
             for k, v in pairs:
-                if v is None and hasattr(obj, '__dict__'):
+                if v is None and is_object:
                     # suppress empty object properties
                     continue
-                exprs.append(k)
-                exprs.append(to_exprs(v))
-            return exprs
-        else:
-            raise Exception(f"Don't know how to serialize {obj}")
-    
-    def exprs_to_str(exprs):
-        "Format the expressions as a string (compact)."
-        if isinstance(exprs, list):
-            strs = []
-            for subexpr in exprs:
-                if isinstance(subexpr, list):
-                    strs.append(exprs_to_str(subexpr))
+                is_empty = False
+                if pretty:
+                    out += ["\n", lead2, f"{k} "]
                 else:
-                    strs.append(f"{subexpr}")
-            text = "(%s)" % " ".join(strs)
+                    out += [" ", f"{k}", " "]
+                emit(v, out, _level+1)
+            if pretty and not is_empty:
+                out += ["\n", lead, ")"]
+            else:
+                out.append(")")
         else:
-            text = f"{exprs}"
-        return text
+            raise Exception(f"Don't know how to serialize {obj}")
+
+    out = []
+    emit(obj, out)
+    return "".join(out)
+
+
+# Walking a class's MRO to find its slots is the slowest part of serializing
+# an object, and the answer is the same for every instance, so it is cached.
+_slot_names = {}
+_missing = object()
 
-    def exprs_to_str_pretty(exprs, indent, _level=0):
-        "Format the expressions as a string (pretty-printed)."
-        if not isinstance(exprs, list):
-            text = f"{exprs}"
-        else:
-            text = "(" + exprs[0]
-            if exprs[0] in ['tuple', 'list', 'set']:
-                for subexpr in exprs[1:]:
-                    lead2 = (" " * indent) * (_level+1)
-                    text += "\n" + lead2 + exprs_to_str_pretty(subexpr, indent, _level+1)
-                lead = (" " * indent) * _level
-                text += "\n" + lead + ")"
-            else:
-                it = iter(exprs[1:])
-                pairs = list(zip(it, it))
-                if len(pairs) == 0:
-                    text += ")"
-                else:
-                    for k, v in pairs:
-                        lead2 = (" " * indent) * (_level+1)
-                        text += "\n" + lead2 + f"{k} "
-                        if isinstance(v, list):
-                            text += exprs_to_str_pretty(v, indent, _level+1)
-                        else:
-                            text += f"{v}"
-                    lead = (" " * indent) * _level
-                    text += "\n" + lead + ")"
-        return text
 
-    exprs = to_exprs(obj)
-    if pretty:
-        return exprs_to_str_pretty(exprs, indent)
-    else:
-        return exprs_to_str(exprs)
+def _get_slot_names(cls) -> tuple:
+    "Return the slot names of a class and its bases (most-derived first)."
+    names = _slot_names.get(cls)
+    if names is None:
+        names = []
+        for klass in cls.__mro__:
+            for name in getattr(klass, '__slots__', ()):
+                if name not in names:
+                    names.append(name)
+        names = tuple(names)
+        _slot_names[cls] = names
+    return names
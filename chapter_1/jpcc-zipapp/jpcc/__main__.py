@@ -2,11 +2,12 @@
 
 import sys
 import os
+import shutil
 
-from jpcc import C
-from jpcc import x86_64
 from jpcc import Targets
-from jpcc import Serialization
+from jpcc import driver
+# note: the compiler passes (and pycparser) are imported as they are needed,
+# so that e.g. --help, or stopping early, doesn't pay for the rest.
 
 
 def usage(fd):
@@ -16,12 +17,23 @@ def usage(fd):
 Standard cc flags:
   -o foo: name the final executable 'foo'.
   -S: emit assembly to '/tmp/<file>.s'.
+    (when compiling several files at once, this is '/tmp/<file>-<hash>.s',
+    where <hash> comes from the input's path, so that e.g. a/foo.c and
+    b/foo.c don't collide.)
   -S -o foo.s: emit assembly to 'foo.s'.
 
 Cross-compilation:
   --target amd64_darwin: compile for amd64_darwin.
   --list-targets: list the supported targets.
 
+Assembly output:
+  --no-comments: emit the bare assembly, without any comments (nor any
+    comment-only lines). This implies --no-default-comments.
+  --no-default-comments: only comment the assembly where codegen has
+    something to say, skipping the generic comments
+    (e.g. 'Jump to the return address.').
+    Has no effect with --no-comments.
+
 Observing AST's:
   --c-ast: print the C AST and exit.
   --asm-ast: print the ASM AST and exit.
@@ -42,6 +54,9 @@ Environment variables:
   JPCC_<target>_SSH_CC: specify the cc to use for remote invocation.
     Example: JPCC_amd64_darwin_SSH_CC=gcc
     Example: JPCC_amd64_darwin_SSH_CC=/opt/gcc-4.9.5/bin/gcc
+  JPCC_CACHE_DIR: where to cache parsed C ASTs (default ~/.cache/jpcc).
+    Example: JPCC_CACHE_DIR=/tmp/jpcc-cache
+    Example: JPCC_CACHE_DIR= (disable the cache)
 
 Example invocations:
   $ jpcc foo.c
@@ -50,6 +65,9 @@ Example invocations:
   $ jpcc -S foo.c
     Emit /tmp/foo.i and /tmp/foo.s.
 
+  $ jpcc -c foo.c bar.c
+    Compile foo.c and bar.c in parallel, emitting ./foo.o and ./bar.o.
+
   $ jpcc -S -o asm.s foo.c
     Emit /tmp/foo.i and ./asm.s.
 
@@ -66,35 +84,48 @@ Example invocations:
     fd.write(msg)
 
 
+# the command line flags and options are fixed, so build their tables once.
+# flags don't expect an argument:
+flag_names = frozenset([
+    '--help',
+    # flags for compatibility with test_compiler from github.com/nlsandler/writing-a-c-compiler-tests:
+    '--lex', '--parse', '--codgen',
+    # standard compiler flags:
+    '-S', '-c',
+    # serialization flags
+    '--c-ast', '--asm-ast',
+    # cross-compilation flags
+    '--list-targets',
+    # assembly output flags
+    '--no-comments', '--no-default-comments',
+])
+
+# options expect a argument:
+option_names = frozenset(['-o', '--target', '--indent'])
+
+# map each known argument to its kind, so that parsing takes one lookup per arg.
+arg_kinds = {
+    **dict.fromkeys(flag_names, 'flag'),
+    **dict.fromkeys(option_names, 'option'),
+}
+
+
 def parse_command_line() -> tuple[set, dict, list]:
     """Parse the command line, returning flags, options, and args.
     Flags don't expect an argument, e.g. '--verbose'.
     Options expect an argument, e.g. '--output file.txt'.
     Args are everything left over after parsing flags and options.
     """
-    # flags don't expect an argument:
-    flag_names = set([
-        '--help',
-        # flags for compatibility with test_compiler from github.com/nlsandler/writing-a-c-compiler-tests:
-        '--lex', '--parse', '--codgen',
-        # standard compiler flags:
-        '-S', '-c',
-        # serialization flags
-        '--c-ast', '--asm-ast',
-        # cross-compilation flags
-        '--list-targets',
-    ])
-    # options expect a argument:
-    option_names = set(['-o', '--target', '--indent'])
     flags = set()
     options = {}
     args = []
     i = 1
     while i < len(sys.argv):
         arg = sys.argv[i]
-        if arg in flag_names:
+        kind = arg_kinds.get(arg)
+        if kind == 'flag':
             flags.add(arg)
-        elif arg in option_names:
+        elif kind == 'option':
             i += 1
             if i >= len(sys.argv):
                 sys.stderr.write(f"Error: option '{arg}' expects an argument.\n")
@@ -109,23 +140,12 @@ def parse_command_line() -> tuple[set, dict, list]:
     return (flags, options, args)
 
 
-def basename(fname: str) -> str:
-    "/foo/bar.txt -> bar.txt"
-    return os.path.split(fname)[1]
-
-
-def drop_ext(fname: str) -> str:
-    "foo.txt -> foo"
-    return os.path.splitext(fname)[0]
-
-
-def shell(cmdline):
-    "Execute a shell command, returning the exit status."
-    status = os.waitstatus_to_exitcode(os.system(cmdline))
-    return status
-
-
 if __name__ == "__main__":
+    # buffer our diagnostics rather than issuing a write() per line.
+    # note: driver.run() flushes before running a command, and python flushes
+    # stderr at exit.
+    sys.stderr.reconfigure(write_through=False)
+
     (g_flags, g_options, g_args) = parse_command_line()
 
     if '--help' in g_flags:
@@ -135,23 +155,21 @@ if __name__ == "__main__":
     # list the targets and exit if requested.
     if '--list-targets' in g_flags:
         print("Supported targets:")
-        for target in Targets.supported_targets:
+        for target in sorted(map(str, Targets.supported_targets)):
             print(target)
         sys.exit(0)
 
-    # determine the input filename.
+    # determine the input filenames.
     if len(g_args) == 0:
         sys.stderr.write("Error: no input filename given.\n")
         usage(sys.stderr)
         sys.exit(1)
-    if len(g_args) > 1:
-        sys.stderr.write(
-            "Error: only one input filename is currently supported, multiple given: %s\n" % g_args
-        )
+    if len(g_args) > 1 and '-o' in g_options:
+        sys.stderr.write("Error: cannot specify '-o' with multiple input files.\n")
         usage(sys.stderr)
         sys.exit(1)
-    c_fname = g_args[0]
-    sys.stderr.write(f"Input: {c_fname}\n")
+    for c_fname in g_args:
+        sys.stderr.write(f"Input: {c_fname}\n")
 
     # determine the target.
     if '--target' in g_options:
@@ -165,124 +183,38 @@ if __name__ == "__main__":
     # find a compiler for preprocessing and final machine code output.
     if "CC" in os.environ:
         cc = os.environ["CC"]
-    elif shell("which gcc >/dev/null 2>&1") == 0:
+    elif shutil.which("gcc"):
         cc = "gcc"
-    elif shell("which clang >/dev/null 2>&1") == 0:
+    elif shutil.which("clang"):
         cc = "clang"
     else:
         sys.stderr.write("Error: can't find a C compiler.\n")
         sys.exit(1)
     sys.stderr.write(f"cc: {cc}\n")
 
-    # preprocess the input.
-    i_fname = "/tmp/" + drop_ext(basename(c_fname)) + ".i"
-    cmdline = f"{cc} -E -P {c_fname} -o {i_fname}"
-    sys.stderr.write(cmdline + '\n')
-    status = shell(cmdline)
-    if status != 0:
-        sys.exit(status)
-
-    indent=4
-    if '--indent' in g_options:
-        indent = int(g_options['--indent'])
-
-    # build the C AST.
-    c_ast = C.parse(i_fname)
-    if '--c-ast' in g_flags:
-        # dump the C AST and exit.
-        print(Serialization.to_exprs_str(c_ast, indent=indent))
-        sys.exit(0)
-    if '--lex' in g_flags or '--parse' in g_flags:
-        # stop after lexing (or parsing).
-        sys.exit(0)
-
-    # generate assembly.
-    asm_ast = x86_64.gen_Program(c_ast)
-    if '--asm-ast' in g_flags:
-        # dump the ASM AST and exit.
-        print(Serialization.to_exprs_str(asm_ast, indent=indent))
-        sys.exit(0)
-    if '-S' in g_flags and '-o' in g_options:
-        s_fname = g_options['-o']
-    else:
-        s_fname = "/tmp/" + drop_ext(basename(c_fname)) + '.s'
-    asm_text = asm_ast.gas()
-    if s_fname == '-':
-        sys.stdout.write(asm_text)
+    if len(g_args) == 1:
+        status = driver.compile_file(g_args[0], g_flags, g_options, cc, Targets.current_target, exec_cc=True)
     else:
-        with open(s_fname, 'w') as fd:
-            fd.write(asm_text)
-            sys.stderr.write(f"Wrote: {s_fname}\n")
-    if '--codegen' in g_flags or '-S' in g_flags:
-        # stop after codegen.
-        sys.exit(0)
-
-    # use gcc to compile the assembly to machine code.
-    # note: test_compiler expects the output binary to
-    # be the basename of the .c file, in the same directory.
-    # so 'cc /foo/bar.c' should produce '/foo/bar'.
-    c_flag = '-c' if '-c' in g_flags else ''
-    if '-o' in g_options:
-        bin_fname = g_options['-o']
-    else:
-        bin_fname = drop_ext(c_fname)
-        if '-c' in g_flags:
-            bin_fname += '.o'
-    cc_flags = f"{c_flag}"
-    envarname = f"JPCC_{Targets.current_target}_SSH_HOST"
-    if envarname in os.environ:
-        # use SSH to run gcc on a remote host.
-        # note: using persistent SSH connections can greatly improve
-        # performance when running lots of tests.
-        # here's my ~/.ssh/config:
-        #   Host *
-        #       ControlMaster auto
-        #       ControlPath  ~/.ssh/%r@%h-%p.socket
-        #       ControlPersist  600
-
-        host = os.environ[envarname]
-        sys.stderr.write(f"{envarname}: {host}\n")
-
-        remote_cc = "gcc"
-        envarname = f"JPCC_{Targets.current_target}_SSH_CC"
-        if envarname in os.environ:
-            remote_cc = os.environ[envarname]
-            sys.stderr.write(f"{envarname}: {remote_cc}\n")
-
-        remote_s_fname = f"/tmp/{basename(s_fname)}"
-        remote_bin_fname = f"/tmp/{basename(bin_fname)}"
-
-        # copy the assembly file to the remote host.
-        cmdline = f"scp -q {s_fname} {host}:{remote_s_fname}"
-        sys.stderr.write(cmdline + '\n')
-        status = shell(cmdline)
-        if status != 0: sys.exit(status)
-
-        # invoke the compiler on the remote host.
-        cmdline = f"ssh {host} 'cd /tmp && {remote_cc} {cc_flags} -o {remote_bin_fname} {remote_s_fname}'"
-        sys.stderr.write(cmdline + '\n')
-        status = shell(cmdline)
-        if status != 0: sys.exit(status)
-
-        # if this was a .o, copy it back to localhost.
-        if bin_fname.endswith('.o'):
-            cmdline = f"scp -q {host}:{remote_bin_fname} {bin_fname}"
-            sys.stderr.write(cmdline + '\n')
-            status = shell(cmdline)
-            sys.exit(status)
-        # if this was an executable, create a wrapper script to invoke it remotely.
+        # each file is compiled independently, so compile them in parallel.
+        # pycparser is CPU-bound pure python, so use processes to sidestep the
+        # GIL, unless we are compiling remotely, where the work is I/O-bound.
+        import itertools
+        import concurrent.futures
+        if f"JPCC_{Targets.current_target}_SSH_HOST" in os.environ:
+            executor_class = concurrent.futures.ThreadPoolExecutor
         else:
-            with open(bin_fname, "w") as fd:
-                script = f"""#!/bin/bash
-set -e
-ssh {host} "{remote_bin_fname} \\"$@\\""
-"""
-                fd.write(script)
-            assert shell(f"chmod +x {bin_fname}") == 0
-
-    else:
-        # assume localhost is the correct target and run gcc locally.
-        cmdline = f"{cc} {c_flag} -o {bin_fname} {s_fname}"
-        sys.stderr.write(cmdline + '\n')
-        status = shell(cmdline)
-        sys.exit(status)
+            executor_class = concurrent.futures.ProcessPoolExecutor
+        sys.stderr.flush()
+        with executor_class(max_workers=os.cpu_count()) as executor:
+            statuses = list(executor.map(
+                driver.compile_file,
+                g_args,
+                itertools.repeat(g_flags),
+                itertools.repeat(g_options),
+                itertools.repeat(cc),
+                itertools.repeat(Targets.current_target),
+                itertools.repeat(False),  # exec_cc
+                itertools.repeat(True),  # unique_temps
+            ))
+        status = next((s for s in statuses if s != 0), 0)
+    sys.exit(status)
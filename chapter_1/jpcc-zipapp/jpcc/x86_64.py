@@ -2,6 +2,8 @@
 
 from __future__ import annotations
 from dataclasses import dataclass
+from enum import Enum
+import functools
 
 from jpcc import Targets
 
@@ -23,7 +25,7 @@ from jpcc import Targets
 #   Instruction2 > Movl
 #        Operand > Imm | Register
 #            Imm : Imm(value: int)
-#       Register > RAX | RBX | ...
+#       Register : Enum(RAX | RBX | ...)
 #     Identifier : Identifier(value: str)
 
 
@@ -61,167 +63,232 @@ from jpcc import Targets
 tab_width = 8  # the visible width of a rendered tab character
 comment_col = 32  # the column at which comments should start.
 
+# when False, no comments are emitted at all (nor are any default ones built).
+emit_comments = True
 
-def _coalesce(x, default_value):
-    "Return the default value if x is None"
-    return x if x is not None else default_value
+# when False, instructions which weren't given a comment don't build their
+# default one (e.g. "Copy $2 to %eax."), which saves formatting their operands.
+emit_default_comments = True
 
+# precomputed runs of spaces, for padding statements out to comment_col.
+_pads = tuple(" " * n for n in range(comment_col + 1))
 
-def _vlen(s: str) -> int:
-    "Return the visible length of a string, assuming tabs are 8 wide"
-    return len(s) + (s.count('\t') * (tab_width - 1))
 
+def _pad(vlen: int) -> str:
+    "Return the padding needed to start a comment after vlen columns."
+    n = comment_col - vlen
+    if 0 <= n < len(_pads):
+        return _pads[n]
+    return " " * n
 
-def _add_comment(stmt: str, comment: str) -> str:
-    "Add a comment to an ASM statement."
-    if stmt is None:
-        stmt = ""
+
+def _emit_comment(out: list[str], vlen: int, comment: str) -> None:
+    "Append a comment to the ASM statement in progress, given its visible length."
+    # note: each statement tracks its visible length (counting its leading tab
+    # as tab_width columns) as it emits, so there is no need to re-measure it.
     if comment is None:
-        return stmt
-    pad = (comment_col - _vlen(stmt)) * " "
+        return
     # Note: '#' is the standard comment character for x86_64, but it appears
     # that it does not work after a directive, e.g. '.globl main # comment'.
     # However, '/* comment */' appears to work everywhere.
-    line = f"{stmt}{pad}/* {comment} */"
-    return line
+    out += [_pad(vlen), "/* ", comment, " */"]
 
 
-class ASM_AST: pass
+def format_label(label: str) -> str:
+    "Return the current target's spelling of a label."
+    return _format_label(Targets.current_target.os, label)
 
 
-class Operand(ASM_AST): pass
+@functools.cache
+def _format_label(os: str, label: str) -> str:
+    # note: keyed on the os as well, so switching targets can't return stale labels.
+    match os:
+        case "darwin":
+            return f"_{label}"
+        case _:
+            return label
 
 
-class Register(Operand):
-    def gas(self) -> str:
-        regname = self.__class__.__name__.lower()
-        return f"%{regname}"
+class ASM_AST:
+    __slots__ = ()
+
+    def __init_subclass__(cls, **kwargs):
+        "Derive each class's mnemonic once, when the class is defined."
+        super().__init_subclass__(**kwargs)
+        cls._op = cls.__name__.lower()
+
 
+class Operand(ASM_AST): __slots__ = ()
 
-# x86_64 64-bit registers:
-# See https://en.wikipedia.org/wiki/X86-64#Architectural_features
 
-# General registers:
-class RAX(Register): pass  # Accumulator register
-class RBX(Register): pass  # Base register
-class RCX(Register): pass  # Counter register
-class RDX(Register): pass  # Data register
+class Register(Operand, Enum):
+    "A register, whose value is its GAS name."
+    # note: registers carry no state, so rather than a class per register
+    # (each instantiated as needed), we use a single enum of shared members.
 
-# Pointer registers:
-class RSP(Register): pass  # Stack pointer
-class RBP(Register): pass  # Base pointer
+    # x86_64 64-bit registers:
+    # See https://en.wikipedia.org/wiki/X86-64#Architectural_features
 
-# Index registers:
-class RDI(Register): pass  # Destination index
-class RSI(Register): pass  # Source index
+    # General registers:
+    RAX = "%rax"  # Accumulator register
+    RBX = "%rbx"  # Base register
+    RCX = "%rcx"  # Counter register
+    RDX = "%rdx"  # Data register
 
-# Other:
-class RIP(Register): pass  # Instruction pointer
+    # Pointer registers:
+    RSP = "%rsp"  # Stack pointer
+    RBP = "%rbp"  # Base pointer
 
-# 32-bit registers:
-class EAX(Register): pass
-class EBX(Register): pass
-class ECX(Register): pass
-class EDX(Register): pass
-class ESP(Register): pass
-class EBP(Register): pass
-class EDI(Register): pass
-class ESI(Register): pass
-class EIP(Register): pass
+    # Index registers:
+    RDI = "%rdi"  # Destination index
+    RSI = "%rsi"  # Source index
 
+    # Other:
+    RIP = "%rip"  # Instruction pointer
+
+    # 32-bit registers:
+    EAX = "%eax"
+    EBX = "%ebx"
+    ECX = "%ecx"
+    EDX = "%edx"
+    ESP = "%esp"
+    EBP = "%ebp"
+    EDI = "%edi"
+    ESI = "%esi"
+    EIP = "%eip"
+
+    def gas(self) -> str:
+        return self.value
 
-@dataclass
+
+@dataclass(slots=True, frozen=True)
 class Imm(Operand):
     value: int
     def gas(self) -> str:
         return f"${self.value}"
 
 
-@dataclass
+@dataclass(slots=True)
 class Instruction(ASM_AST):
     comment: str = None
+
+    def __init_subclass__(cls, **kwargs):
+        "Render each instruction's leading tab and mnemonic once."
+        # note: zero-arg super() doesn't work in a slots dataclass, as the
+        # decorator replaces the class.
+        super(Instruction, cls).__init_subclass__(**kwargs)
+        cls._prefix = f"\t{cls._op} "
+
     def get_comment(self) -> str:
         "This getter allows instructions to provide a default comment."
         return self.comment
 
+    def gas(self) -> str:
+        out = []
+        self.emit(out)
+        return "".join(out)
+
 
 class Instruction0(Instruction):
     "An instruction of artiy 0."
-    def gas(self) -> str:
-        op = self.__class__.__name__.lower()
-        line = f"\t{op}"
-        line = _add_comment(line, self.get_comment())
-        return line
+    __slots__ = ()
+
+    def emit(self, out: list[str]) -> None:
+        "Append the fragments of this instruction's line to out."
+        out += ["\t", self._op]
+        vlen = tab_width + len(self._op)
+        if emit_comments:
+            _emit_comment(out, vlen, self.get_comment())
 
 
 class Instruction2(Instruction):
     "An instruction of artiy 2."
+    __slots__ = ("src", "dst")
+
     def __init__(self, *, src: Operand, dst: Operand, comment: str = None):
         self.src = src
         self.dst = dst
         self.comment = comment
 
-    def gas(self) -> str:
-        op = self.__class__.__name__.lower()
+    def emit(self, out: list[str]) -> None:
+        "Append the fragments of this instruction's line to out."
         src_str = self.src.gas()
         dst_str = self.dst.gas()
-        line = f"\t{op} {src_str}, {dst_str}"
-        line = _add_comment(line, self.get_comment())
-        return line
+        out += [self._prefix, src_str, ", ", dst_str]
+        vlen = (tab_width - 1) + len(self._prefix) + len(src_str) + 2 + len(dst_str)
+        if emit_comments:
+            _emit_comment(out, vlen, self.get_comment())
 
 
 class Movl(Instruction2):
+    __slots__ = ()
+
     def get_comment(self) -> str:
-        default = f"Copy {self.src.gas()} to {self.dst.gas()}."
-        return _coalesce(super().get_comment(), default)
+        # note: only build the default comment if it is actually needed.
+        if self.comment is not None or not emit_default_comments:
+            return self.comment
+        return f"Copy {self.src.gas()} to {self.dst.gas()}."
 
 
 class Ret(Instruction0):
+    __slots__ = ()
+
     def get_comment(self) -> str:
-        default = f"Jump to the return address."
-        return _coalesce(super().get_comment(), default)
+        if self.comment is not None or not emit_default_comments:
+            return self.comment
+        return "Jump to the return address."
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class Identifier(ASM_AST):
     value: str
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class Function(ASM_AST):
     name: Identifier
     instructions: list[Instruction]
 
-    def gas(self) -> str:
-        def make_label(fn_name: str) -> str:
-            match Targets.current_target.os:
-                case "darwin":
-                    return f"_{fn_name}"
-                case _:
-                    return fn_name
-        lines = []
-        label = make_label(self.name)
-        globl_stmt = _add_comment(
-            f"\t.globl {label}",
-            f"Make {label} globally visible."
-        )
-        lines.append(globl_stmt)
-        label_stmt = _add_comment(
-            f"{label}:",
-            f"Begin function {self.name}."
-        )
-        lines.append(label_stmt)
+    def emit(self, out: list[str]) -> None:
+        "Append the fragments of this function's assembly to out."
+        label = format_label(self.name)
+        out += ["\t.globl ", label]
+        if emit_comments:
+            _emit_comment(out, tab_width + len(".globl ") + len(label), f"Make {label} globally visible.")
+        out += ["\n", label, ":"]
+        if emit_comments:
+            _emit_comment(out, len(label) + 1, f"Begin function {self.name}.")
+        out.append("\n")
         for instruction in self.instructions:
-            lines.append(instruction.gas())
-        asm_text = '\n'.join(lines) + '\n'
-        return asm_text
+            instruction.emit(out)
+            out.append("\n")
+
+    def gas(self) -> str:
+        # build the whole function as one list of fragments and join it once,
+        # rather than formatting (and then re-joining) a string per line.
+        out = []
+        self.emit(out)
+        return "".join(out)
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class Program(ASM_AST):
     funcdef: Function
+    def emit(self, out: list[str]) -> None:
+        self.funcdef.emit(out)
+
     def gas(self) -> str:
-        return self.funcdef.gas()
+        out = []
+        self.emit(out)
+        return "".join(out)
+
+    def write(self, fd) -> None:
+        "Write the assembly to a file."
+        # note: this hands the fragments to the file as-is, rather than first
+        # joining them into one string.
+        out = []
+        self.emit(out)
+        fd.writelines(out)
 
 
 from jpcc import C
@@ -241,7 +308,7 @@ def gen_Program(c_ast: C.Program) -> Program:
             instructions = [
                 Movl(
                     src = Imm(c_expr_ast.value),
-                    dst = EAX(),
+                    dst = Register.EAX,
                     comment = f"Return value = {c_expr_ast.value}."
                 ),
                 Ret(),
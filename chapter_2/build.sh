@@ -4,4 +4,16 @@
 
 set -e
 
-python3 -m zipapp -p "/usr/bin/env python3" jpcc-zipapp -o jpcc
+# stage a copy of the sources, so that we can byte-compile them without
+# littering the source tree.
+build_dir=$(mktemp -d)
+trap 'rm -rf "$build_dir"' EXIT
+cp -R jpcc-zipapp "$build_dir/"
+rm -rf "$build_dir"/jpcc-zipapp/__pycache__ "$build_dir"/jpcc-zipapp/jpcc/__pycache__
+
+# ship a .pyc alongside each .py, so that zipimport can skip compiling the
+# sources on every run. note: the .py files are kept, as zipimport falls
+# back to them if the running python3 has a different bytecode version.
+python3 -m compileall -q -b "$build_dir/jpcc-zipapp"
+
+python3 -m zipapp -p "/usr/bin/env python3" "$build_dir/jpcc-zipapp" -o jpcc
@@ -2,6 +2,8 @@
 
 from __future__ import annotations
 from dataclasses import dataclass
+from enum import Enum
+import functools
 
 
 # Nora Sandler's ASDL for the subset of ASM from chapter 2:
@@ -30,7 +32,7 @@ from dataclasses import dataclass
 #   Instruction2 > Movl | Movq | Subq
 #        Operand > Imm | Register | Stack
 #            Imm : Imm(value: int)
-#       Register > RAX | RBX | ...
+#       Register : Enum(RAX | RBX | ...)
 #          Stack : Stack(offset: int)
 #        Comment : Comment(comment: str)
 
@@ -50,254 +52,403 @@ from jpcc import targets
 tab_width = 8  # the visible width of a rendered tab character
 comment_col = 32  # the column at which comments should start.
 
+# when False, no comments are emitted at all (nor are any default ones built).
+emit_comments = True
 
-def _coalesce(x, default_value):
-    "Return the default value if x is None."
-    return x if x is not None else default_value
+# when False, instructions which weren't given a comment don't build their
+# default one (e.g. "Negate %r11d."), which saves formatting their operands.
+emit_default_comments = True
 
 
-def _vlen(s: str) -> int:
-    "Return the visible length of a string, assuming tabs are 8 wide."
-    return len(s) + (s.count('\t') * (tab_width - 1))
+# precomputed runs of spaces, for padding statements out to comment_col.
+_pads = tuple(" " * n for n in range(comment_col + 1))
 
 
-def _add_comment(stmt: str, comment: str, c_style: bool = False) -> str:
-    "Add a comment to an ASM statement."
-    if stmt is None:
-        stmt = ""
+def _pad(vlen: int) -> str:
+    "Return the padding needed to start a comment after vlen columns."
+    n = comment_col - vlen
+    if 0 <= n < len(_pads):
+        return _pads[n]
+    return " " * n
+
+
+def _emit_comment(out: list[str], vlen: int, comment: str, c_style: bool = False) -> None:
+    "Append a comment to the ASM statement in progress, given its visible length."
+    # note: each statement tracks its visible length (counting its leading tab
+    # as tab_width columns) as it emits, so there is no need to re-measure it.
     if comment is None:
-        return stmt
-    pad = (comment_col - _vlen(stmt)) * " "
+        return
+    out.append(_pad(vlen))
     if c_style:
         # Note: '#' is the standard comment character for x86_64, but it appears
         # that it does not work after a directive, e.g. '.globl main # comment'.
         # However, '.globl main /* comment */' appears to work.
-        line = f"{stmt}{pad}/* {comment} */"
+        out += ["/* ", comment, " */"]
     else:
-        line = f"{stmt}{pad}# {comment}"
-    return line
+        out += ["# ", comment]
 
 
 def format_label(label: str) -> str:
-    match targets.current_target.os:
+    "Return the current target's spelling of a label."
+    return _format_label(targets.current_target.os, label)
+
+
+@functools.cache
+def _format_label(os: str, label: str) -> str:
+    # note: keyed on the os as well, so switching targets can't return stale labels.
+    match os:
         case "darwin":
             return f"_{label}"
         case _:
             return label
 
 
-class ASM_AST: pass
+class ASM_AST:
+    __slots__ = ()
+
+    def __init_subclass__(cls, **kwargs):
+        "Derive each class's mnemonic once, when the class is defined."
+        super().__init_subclass__(**kwargs)
+        cls._op = cls.__name__.lower()
+
+
+class Fixup(ASM_AST): __slots__ = ()
 
 
-class Fixup(ASM_AST): pass
+class Operand(ASM_AST): __slots__ = ()
 
 
-class Operand(ASM_AST): pass
+class Register(Operand, Enum):
+    "A register, whose value is its GAS name."
+    # note: registers carry no state, so rather than a class per register, we
+    # use a single enum of shared members, which can be compared by identity.
 
+    # x86_64 64-bit registers:
+    # See https://en.wikipedia.org/wiki/X86-64#Architectural_features
+
+    # General registers:
+    RAX = "%rax"  # Accumulator register
+    RBX = "%rbx"  # Base register
+    RCX = "%rcx"  # Counter register
+    RDX = "%rdx"  # Data register
+
+    # Pointer registers:
+    RSP = "%rsp"  # Stack pointer
+    RBP = "%rbp"  # Base pointer
+
+    # Index registers:
+    RDI = "%rdi"  # Destination index
+    RSI = "%rsi"  # Source index
+
+    # Other:
+    RIP = "%rip"  # Instruction pointer
+
+    R8 = "%r8"
+    R9 = "%r9"
+    R10 = "%r10"
+    R11 = "%r11"
+    R12 = "%r12"
+    R13 = "%r13"
+    R14 = "%r14"
+    R15 = "%r15"
+
+    # 32-bit registers:
+    EAX = "%eax"
+    EBX = "%ebx"
+    ECX = "%ecx"
+    EDX = "%edx"
+    ESP = "%esp"
+    EBP = "%ebp"
+    EDI = "%edi"
+    ESI = "%esi"
+    EIP = "%eip"
+    R8D = "%r8d"
+    R9D = "%r9d"
+    R10D = "%r10d"
+    R11D = "%r11d"
+    R12D = "%r12d"
+    R13D = "%r13d"
+    R14D = "%r14d"
+    R15D = "%r15d"
 
-class Register(Operand):
     def gas(self) -> str:
-        regname = self.__class__.__name__.lower()
-        return f"%{regname}"
-
-
-# x86_64 64-bit registers:
-# See https://en.wikipedia.org/wiki/X86-64#Architectural_features
-
-# General registers:
-class RAX(Register): pass  # Accumulator register
-class RBX(Register): pass  # Base register
-class RCX(Register): pass  # Counter register
-class RDX(Register): pass  # Data register
-
-# Pointer registers:
-class RSP(Register): pass  # Stack pointer
-class RBP(Register): pass  # Base pointer
-
-# Index registers:
-class RDI(Register): pass  # Destination index
-class RSI(Register): pass  # Source index
-
-# Other:
-class RIP(Register): pass  # Instruction pointer
-
-class R8(Register): pass
-class R9(Register): pass
-class R10(Register): pass
-class R11(Register): pass
-class R12(Register): pass
-class R13(Register): pass
-class R14(Register): pass
-class R15(Register): pass
-
-# 32-bit registers:
-class EAX(Register): pass
-class EBX(Register): pass
-class ECX(Register): pass
-class EDX(Register): pass
-class ESP(Register): pass
-class EBP(Register): pass
-class EDI(Register): pass
-class ESI(Register): pass
-class EIP(Register): pass
-class R8D(Register): pass
-class R9D(Register): pass
-class R10D(Register): pass
-class R11D(Register): pass
-class R12D(Register): pass
-class R13D(Register): pass
-class R14D(Register): pass
-class R15D(Register): pass
-
-
-@dataclass
+        return self.value
+
+
+# note: the operands, labels, directives and the program are hand-written
+# rather than dataclasses: nothing needs their synthesized __eq__ or __repr__,
+# and a plain __init__ is cheaper to call.
+
 class Imm(Operand):
-    value: int
+    __slots__ = ("value",)
+
+    def __init__(self, value: int):
+        self.value = value
+
     def gas(self) -> str:
         return f"${self.value}"
 
 
-@dataclass
 class Stack(Operand):
-    offset: int
+    __slots__ = ("offset",)
+
+    def __init__(self, offset: int):
+        self.offset = offset
+
     def gas(self) -> str:
         return f"{self.offset}(%rbp)"
 
 
-@dataclass
+# Imm and Stack operands are never modified, so (like CPython's small ints) we
+# preallocate and share the small immediates. Stack slots are all shared, so
+# that there is only ever one Stack for each offset.
+_small_imms = [Imm(value) for value in range(-256, 257)]
+
+
+def imm(value: int) -> Imm:
+    "Return an Imm of the value, sharing the instance if the value is small."
+    if -256 <= value <= 256:
+        return _small_imms[value + 256]
+    return Imm(value)
+
+
+@functools.cache
+def stack(offset: int) -> Stack:
+    "Return the (shared) Stack at the offset."
+    return Stack(offset)
+
+
+@dataclass(slots=True)
 class Statement(ASM_AST):
     comment: str = None
     def get_comment(self) -> str:
         "This getter allows statements to provide a default comment."
         return self.comment
 
+    def gas(self) -> str:
+        out = []
+        self.emit(out)
+        return "".join(out)
+
 
 class Comment(Statement):
     "A bare comment."
-    def gas(self) -> str:
-        line = _add_comment(None, self.comment)
-        return line
+    __slots__ = ()
+
+    def emit(self, out: list[str]) -> None:
+        "Append the fragments of this statement's line to out."
+        if emit_comments:
+            _emit_comment(out, 0, self.comment)
+
 
+def _skipped_statement_type() -> type:
+    "The type of statement to leave out entirely (rather than emit as an empty line)."
+    # note: without comments, a Comment's line would be blank.
+    return None if emit_comments else Comment
 
-class Instruction(Statement): pass
+
+class Instruction(Statement):
+    __slots__ = ()
+
+    def __init_subclass__(cls, **kwargs):
+        "Render each instruction's leading tab and mnemonic once."
+        super().__init_subclass__(**kwargs)
+        cls._prefix = f"\t{cls._op} "
 
 
 class Instruction0(Instruction):
     "An instruction of artiy 0."
-    def gas(self) -> str:
-        op = self.__class__.__name__.lower()
-        line = f"\t{op}"
-        line = _add_comment(line, self.get_comment())
-        return line
+    __slots__ = ()
+
+    def emit(self, out: list[str]) -> None:
+        "Append the fragments of this instruction's line to out."
+        out += ["\t", self._op]
+        if emit_comments:
+            _emit_comment(out, tab_width + len(self._op), self.get_comment())
 
 
 class Ret(Instruction0):
+    __slots__ = ()
+
     def get_comment(self) -> str:
-        default = f"Jump to the return address."
-        return _coalesce(super().get_comment(), default)
+        # note: only build the default comment if it is actually needed.
+        if self.comment is not None or not emit_default_comments:
+            return self.comment
+        return f"Jump to the return address."
 
 
 class Instruction1(Instruction):
     "An instruction of artiy 1."
+    __slots__ = ("arg",)
+
     def __init__(self, arg: Operand, comment: str = None):
         self.arg = arg
         self.comment = comment
 
-    def gas(self) -> str:
-        op = self.__class__.__name__.lower()
-        line = f"\t{op} {self.arg.gas()}"
-        line = _add_comment(line, self.get_comment())
-        return line
+    def emit(self, out: list[str]) -> None:
+        "Append the fragments of this instruction's line to out."
+        arg_str = self.arg.gas()
+        out += [self._prefix, arg_str]
+        vlen = (tab_width - 1) + len(self._prefix) + len(arg_str)
+        if emit_comments:
+            _emit_comment(out, vlen, self.get_comment())
 
 
 class Pushq(Instruction1):
+    __slots__ = ()
+
     def get_comment(self) -> str:
-        default = f"Copy {self.arg.gas()} on the stack and decrement %rsp."
-        return _coalesce(super().get_comment(), default)
+        if self.comment is not None or not emit_default_comments:
+            return self.comment
+        return f"Copy {self.arg.gas()} on the stack and decrement %rsp."
 
 
 class Popq(Instruction1):
+    __slots__ = ()
+
     def get_comment(self) -> str:
-        default = f"Copy the top of the stack into {self.arg.gas()} and increment %rsp."
-        return _coalesce(super().get_comment(), default)
+        if self.comment is not None or not emit_default_comments:
+            return self.comment
+        return f"Copy the top of the stack into {self.arg.gas()} and increment %rsp."
 
 
 class Negl(Instruction1):
+    __slots__ = ()
+
     def get_comment(self) -> str:
-        default = f"Negate {self.arg.gas()}."
-        return _coalesce(super().get_comment(), default)
+        if self.comment is not None or not emit_default_comments:
+            return self.comment
+        return f"Negate {self.arg.gas()}."
 
 
 class Notl(Instruction1):
+    __slots__ = ()
+
     def get_comment(self) -> str:
-        default = f"Flip all of the bits of {self.arg.gas()}."
-        return _coalesce(super().get_comment(), default)
+        if self.comment is not None or not emit_default_comments:
+            return self.comment
+        return f"Flip all of the bits of {self.arg.gas()}."
 
 
 class Instruction2(Instruction):
     "An instruction of artiy 2."
+    __slots__ = ("src", "dst")
+
     def __init__(self, *, src: Operand, dst: Operand, comment: str = None):
         self.src = src
         self.dst = dst
         self.comment = comment
 
-    def gas(self) -> str:
-        op = self.__class__.__name__.lower()
+    def emit(self, out: list[str]) -> None:
+        "Append the fragments of this instruction's line to out."
         src_str = self.src.gas()
         dst_str = self.dst.gas()
-        line = f"\t{op} {src_str}, {dst_str}"
-        line = _add_comment(line, self.get_comment())
-        return line
+        out += [self._prefix, src_str, ", ", dst_str]
+        vlen = (tab_width - 1) + len(self._prefix) + len(src_str) + 2 + len(dst_str)
+        if emit_comments:
+            _emit_comment(out, vlen, self.get_comment())
 
 
 class Movl(Instruction2):
+    __slots__ = ()
+
     def get_comment(self) -> str:
-        default = f"Copy (32-bit) {self.src.gas()} to {self.dst.gas()}."
-        return _coalesce(super().get_comment(), default)
+        if self.comment is not None or not emit_default_comments:
+            return self.comment
+        return f"Copy (32-bit) {self.src.gas()} to {self.dst.gas()}."
 
 
 class Movq(Instruction2):
+    __slots__ = ()
+
     def get_comment(self) -> str:
-        default = f"Copy {self.src.gas()} to {self.dst.gas()}."
-        return _coalesce(super().get_comment(), default)
+        if self.comment is not None or not emit_default_comments:
+            return self.comment
+        return f"Copy {self.src.gas()} to {self.dst.gas()}."
 
 
 class Subq(Instruction2):
+    __slots__ = ()
+
     def get_comment(self) -> str:
-        default = f"Subtract {self.src.gas()} from {self.dst.gas()} into {self.dst.gas()}"
-        return _coalesce(super().get_comment(), default)
+        if self.comment is not None or not emit_default_comments:
+            return self.comment
+        return f"Subtract {self.src.gas()} from {self.dst.gas()} into {self.dst.gas()}"
 
 
-@dataclass
 class LabelDef(Statement):
+    __slots__ = ("name",)
+
     def __init__(self, name: str, comment: str = None):
         self.name = name
         self.comment = comment
 
-    def gas(self) -> str:
-        line = f"{format_label(self.name)}:"
-        line = _add_comment(line, self.get_comment())
-        return line
+    def emit(self, out: list[str]) -> None:
+        "Append the fragments of this label's line to out."
+        label = format_label(self.name)
+        out += [label, ":"]
+        if emit_comments:
+            _emit_comment(out, len(label) + 1, self.get_comment())
 
 
-@dataclass
 class Directive(Statement):
+    __slots__ = ("name", "content")
+
     def __init__(self, name: str, content: str = None, comment: str = None):
         self.name = name
         self.content = content
         self.comment = comment
 
-    def gas(self) -> str:
-        if self.content is None:
-            line = f"\t{self.name}"
-        else:
-            line = f"\t{self.name} {self.content}"
-        line = _add_comment(line, self.get_comment(), c_style=True)
-        return line
+    def emit(self, out: list[str]) -> None:
+        "Append the fragments of this directive's line to out."
+        out += ["\t", self.name]
+        vlen = tab_width + len(self.name)
+        if self.content is not None:
+            out += [" ", self.content]
+            vlen += 1 + len(self.content)
+        if emit_comments:
+            _emit_comment(out, vlen, self.get_comment(), c_style=True)
 
 
-@dataclass
 class Program(ASM_AST):
-    statements: list[Statement]
+    __slots__ = ("statements",)
+
+    def __init__(self, statements: list[Statement]):
+        self.statements = statements
+
+    def emit(self, out: list[str]) -> None:
+        "Append the fragments of the whole program's assembly to out."
+        skipped = _skipped_statement_type()
+        for statement in self.statements:
+            if type(statement) is skipped:
+                continue
+            statement.emit(out)
+            out.append("\n")
+
     def gas(self) -> str:
-        return "\n".join([s.gas() for s in self.statements]) + "\n"
+        out = []
+        self.emit(out)
+        return "".join(out)
+
+    def write(self, fd) -> None:
+        "Write the assembly to a file."
+        # note: this hands the fragments to the file as-is, rather than first
+        # joining them into one string, and does so in batches, so that the
+        # fragments of a large program are never all held at once.
+        out = []
+        skipped = _skipped_statement_type()
+        for statement in self.statements:
+            if type(statement) is skipped:
+                continue
+            statement.emit(out)
+            out.append("\n")
+            if len(out) >= _write_batch_size:
+                fd.writelines(out)
+                out.clear()
+        fd.writelines(out)
+
+
+# the number of fragments Program.write() accumulates before writing them.
+# note: the file object does its own buffering (and encoding), so this only
+# needs to be large enough to amortize the writelines() call.
+_write_batch_size = 4096
@@ -31,42 +31,56 @@ except:
 #   UnaryOperator > Complement | Negate
 
 
-class C_AST: pass
+# note: AST nodes compare (and hash) by identity: nothing needs value
+# equality, and identical subtrees are shared anyway (see pycp_to_c.py).
 
 
-class Expression(C_AST): pass
+class C_AST: __slots__ = ()
 
 
-class UnaryOperator(C_AST): pass
-class Complement(UnaryOperator): pass
-class Negate(UnaryOperator): pass
+class Expression(C_AST): __slots__ = ()
 
 
-@dataclass
+class UnaryOperator(C_AST):
+    __slots__ = ()
+
+    def __reduce__(self):
+        "Unpickle as the shared instance (e.g. NEGATE) rather than a copy."
+        return self.__class__.__name__.upper()
+
+class Complement(UnaryOperator): __slots__ = ()
+class Negate(UnaryOperator): __slots__ = ()
+
+# the unary operators carry no state, so share a single instance of each.
+COMPLEMENT = Complement()
+NEGATE = Negate()
+
+
+@dataclass(slots=True, frozen=True, eq=False)
 class Unary(Expression):
     op: UnaryOperator
     expr: Expression
 
 
-@dataclass
+@dataclass(slots=True, frozen=True, eq=False)
 class Constant(Expression):
     value: int
 
 
-class Statement(C_AST): pass
+class Statement(C_AST): __slots__ = ()
 
 
-@dataclass
+@dataclass(slots=True, frozen=True, eq=False)
 class Return(Statement):
     expr: Constant
 
 
-@dataclass
+@dataclass(slots=True, frozen=True, eq=False)
 class Function(C_AST):
     name: str
     body: Return
 
 
-@dataclass
+@dataclass(slots=True, frozen=True, eq=False)
 class Program(C_AST):
     funcdef: Function
@@ -1,7 +1,9 @@
 # This file translates chapter 2 C AST into a chapter 2 TAC AST.
 # See "Writing a C Compiler" by Nora Sandler.
 
-from dataclasses import dataclass
+import sys
+import itertools
+from typing import Callable
 
 # So for return-comp-neg-2.c:
 #
@@ -99,84 +101,130 @@ from jpcc import tac
 from jpcc import c
 
 
-@dataclass
-class State:
-    nextTmp: int = 0
+# Temporaries are numbered per program. Rather than keeping the counter in
+# module state, each translation creates its own and threads a 'next_tmp'
+# callable (which claims the next tmp number) down through the translators.
 
-g_state = State()
+# Note: the C AST is assumed to be well-formed (pycp_to_c has already rejected
+# anything unsupported), so the translators don't re-check node types.
 
-def _next_tmp(state=g_state) -> tac.Var:
-    "Claim the next tmp number and return a tmp Var."
-    varname = f"tmp{state.nextTmp}"
-    state.nextTmp += 1
-    return tac.Var(varname)
 
+def c_to_tac(c_ast: c.Program, fold_constants: bool = False) -> tac.Program:
+    "Translate from a C AST to a TAC AST, optionally folding constant expressions."
+    return _translate_Program(c_ast, fold_constants)
 
-def c_to_tac(c_ast: c.Program) -> tac.Program:
-    "Translate from a C AST to a TAC AST."
-    return _translate_Program(c_ast)
 
-
-def _translate_Program(c_ast: c.Program) -> tac.Program:
-    assert isinstance(c_ast, c.Program)
-    funcdef = _translate_Function(c_ast.funcdef)
+def _translate_Program(c_ast: c.Program, fold_constants: bool) -> tac.Program:
+    next_tmp = itertools.count().__next__
+    funcdef = _translate_Function(c_ast.funcdef, next_tmp, fold_constants)
     return tac.Program(funcdef)
 
 
-def _translate_Function(c_ast: c.Function) -> tac.Function:
-    assert isinstance(c_ast, c.Function)
+def _translate_Function(c_ast: c.Function, next_tmp: Callable[[], int], fold_constants: bool) -> tac.Function:
     name = c_ast.name
-    body = _translate_Statement(c_ast.body)
+    body = _translate_Statement(c_ast.body, next_tmp, fold_constants)
     return tac.Function(name, body)
 
 
-def _translate_Statement(c_ast: c.Statement) -> list[tac.Instruction]:
-    assert isinstance(c_ast, c.Statement)
-    assert isinstance(c_ast, c.Return)
-    instructions = []
-    match c_ast:
-        case c.Return(c.Constant() as con):
-            instructions += [tac.Return(tac.Constant(con.value))]
-        case c.Return(c.Unary() as un):
-            (expr_instructions, last_tmp) = _translate_Expression(un)
-            instructions += [*expr_instructions, tac.Return(last_tmp)]
-        case _:
-            raise Exception("Unreachable")
+def _translate_Statement(c_ast: c.Statement, next_tmp: Callable[[], int], fold_constants: bool) -> list[tac.Instruction]:
+    translate_fn = _statement_translators.get(type(c_ast))
+    if translate_fn is None:
+        raise Exception(f"Unsupported statement {c_ast}")
+    return translate_fn(c_ast, next_tmp, fold_constants)
+
+
+def _translate_Return(c_ast: c.Return, next_tmp: Callable[[], int], fold_constants: bool) -> list[tac.Instruction]:
+    (instructions, val) = _translate_Expression(c_ast.expr, next_tmp, fold_constants)
+    instructions.append(tac.Return(val))
     return instructions
 
 
-def _translate_UnaryOperator(c_ast: c.UnaryOperator) -> tac.UnaryOperator:
-    assert isinstance(c_ast, c.UnaryOperator)
-    match c_ast:
-        case c.Complement(): return tac.Complement()
-        case c.Negate(): return tac.Negate()
-        case _: raise Exception("Unreachable")
-
-
-def _translate_Constant(c_ast: c.Constant) -> tac.UnaryOperator:
-    assert isinstance(c_ast, c.Constant)
-    return tac.Constant(c_ast.value)
-
-
-def _translate_Expression(c_ast: c.Expression) -> tuple[list[tac.Instruction],str]:
-    "Translate a c.Expression, returning a list of expressions and the name of the last temporary."
-    match c_ast:
-        case c.Unary(op, c.Constant() as con):
-            dst = _next_tmp()
-            instructions = [tac.Unary(
-                op = _translate_UnaryOperator(op),
-                src = _translate_Constant(con),
-                dst = dst,
-            )]
-            return (instructions, dst)
-        case c.Unary(op, c.Unary() as inner_un):
-            (instructions, inner_tmp) = _translate_Expression(inner_un)
-            dst = _next_tmp()
-            instructions += [tac.Unary(
-                op = _translate_UnaryOperator(op),
-                src = inner_tmp,
-                dst = dst,
-            )]
-            return (instructions, dst)
-        case _:
-            raise Exception(f"Unreachable")
+def _translate_Expression(c_ast: c.Expression, next_tmp: Callable[[], int], fold_constants: bool) -> tuple[list[tac.Instruction],tac.Operand]:
+    "Translate a c.Expression, returning a list of instructions and the operand holding its value."
+    # note: rather than recursing once per nesting level, walk down the
+    # chain of unary operators to the operand, then emit the instructions
+    # from the inside out.
+    # note: this is the hot loop of the translator, so module and attribute
+    # lookups are hoisted into locals and nodes are built positionally.
+    Unary = c.Unary
+    unary_ops = _unary_ops
+    ops = []
+    while type(c_ast) is Unary:
+        ops.append(unary_ops[type(c_ast.op)])
+        c_ast = c_ast.expr
+    translate_fn = _operand_translators.get(type(c_ast))
+    if translate_fn is None:
+        raise Exception(f"Unsupported expression {c_ast}")
+    src = translate_fn(c_ast)
+    return unaries_to_tac(ops, src, next_tmp, fold_constants)
+
+
+def unaries_to_tac(ops: list[tac.UnaryOperator], src: tac.Operand, next_tmp: Callable[[], int], fold_constants: bool = False) -> tuple[list[tac.Instruction],tac.Operand]:
+    "Apply a chain of unary operators (outermost first) to src, returning a list of instructions and the operand holding its value."
+    # note: pycp_to_c also calls this, when it translates straight into TAC,
+    # so that both paths name temporaries and fold constants identically.
+    if fold_constants and type(src) is tac.Constant:
+        # the whole chain is known at compile time, so emit no instructions.
+        return ([], make_constant(_fold_unaries(ops, src.value)))
+    TacUnary = tac.Unary
+    Var = tac.Var
+    intern = sys.intern
+    instructions = []
+    append = instructions.append
+    for op in reversed(ops):
+        dst = Var(intern(f"tmp{next_tmp()}"))
+        append(TacUnary(op, src, dst))
+        src = dst
+    return (instructions, src)
+
+
+def _translate_Constant(c_ast: c.Constant) -> tac.Constant:
+    return make_constant(c_ast.value)
+
+
+def make_constant(value: int) -> tac.Constant:
+    "Return a TAC Constant for value, sharing the preallocated small ones."
+    if -256 <= value <= 256:
+        return _small_constants[value + 256]
+    return tac.Constant(value)
+
+
+# most constants are small, so (like CPython's small ints) preallocate those.
+_small_constants = [tac.Constant(value) for value in range(-256, 257)]
+
+
+# jump tables, keyed by C AST node type.
+_statement_translators = {
+    c.Return: _translate_Return,
+}
+_operand_translators = {
+    c.Constant: _translate_Constant,
+}
+_unary_ops = {
+    c.Complement: tac.COMPLEMENT,
+    c.Negate: tac.NEGATE,
+}
+
+
+# Constant folding (--fold-constants):
+# In chapter 2, every expression is a chain of unary operators applied to a
+# constant, so the whole chain can be evaluated at translation time, e.g.:
+#   Return(Unary(Complement, Unary(Negate, Constant(2))))
+# becomes a lone TAC Return, with no temporaries:
+#   Return(Constant(1))
+# note: this is the only place which folds constants. Rather than rewriting
+# the C AST in a separate pass ahead of translation, unaries_to_tac folds a
+# chain as soon as the walk down it reaches a Constant.
+
+def _fold_unaries(ops: list[tac.UnaryOperator], value: int) -> int:
+    "Apply a chain of unary operators (outermost first) to a constant value."
+    for op in reversed(ops):
+        value = _fold_ops[op](value)
+    # wrap around to a 32-bit signed int, as the target's arithmetic would.
+    return ((value + 2**31) % 2**32) - 2**31
+
+
+_fold_ops = {
+    tac.COMPLEMENT: lambda value: ~value,
+    tac.NEGATE: lambda value: -value,
+}
@@ -0,0 +1,252 @@
+# This file compiles a single C file, from preprocessing through to the final
+# call to cc.
+# note: this lives outside of __main__.py so that worker processes can import
+# compile_file(): with the 'spawn' start method (the default on macOS), a
+# worker can't find functions defined in the parent's __main__ module.
+
+import sys
+import re
+import os
+import subprocess
+import shlex
+import hashlib
+
+from jpcc import targets
+
+
+def basename(fname: str) -> str:
+    "/foo/bar.txt -> bar.txt"
+    return os.path.split(fname)[1]
+
+
+def temp_fname(c_fname: str, stem: str, ext: str, unique: bool) -> str:
+    "/foo/bar.c -> /tmp/bar.ext (or /tmp/bar-1a2b3c4d.ext, if unique)"
+    if not unique:
+        return f"/tmp/{stem}{ext}"
+    # note: when several inputs are compiled at once, the name also carries a
+    # hash of the input's path, to keep e.g. a/foo.c and b/foo.c apart.
+    # It is deterministic, so recompiling a file overwrites its old output.
+    path_hash = hashlib.blake2b(os.path.abspath(c_fname).encode(), digest_size=4).hexdigest()
+    return f"/tmp/{stem}-{path_hash}{ext}"
+
+
+def needs_preprocessing(fname: str) -> bool:
+    "Could the C file use any preprocessor features?"
+    # note: besides directives, 'cc -E' also strips comments and joins
+    # continued lines, neither of which pycparser can handle itself.
+    # note: any other identifier could be a predefined macro (e.g. __LINE__,
+    # or 'linux' in gnu mode), so only skip cc when all of the identifiers are
+    # ones which the compiler itself understands.
+    try:
+        with open(fname, 'rb') as fd:
+            data = fd.read()
+    except OSError:
+        # let the preprocessor report the error.
+        return True
+    if _directive_re.search(data) or b'/' in data or b'\\' in data:
+        return True
+    return not _plain_identifiers.issuperset(_identifier_re.findall(data))
+
+
+# a preprocessor directive: a line whose first non-blank character is '#'.
+_directive_re = re.compile(rb'^[ \t\f\v]*#', re.MULTILINE)
+
+# an identifier (or keyword), but not e.g. the 'x1f' of a hex literal.
+_identifier_re = re.compile(rb'\b[A-Za-z_][A-Za-z0-9_]*')
+
+# the identifiers which no (predefined) macro will expand.
+_plain_identifiers = frozenset([b'int', b'void', b'return', b'main'])
+
+
+# options to share a persistent, multiplexed connection across ssh invocations.
+ssh_opts = "-o ControlMaster=auto -o 'ControlPath=~/.ssh/%r@%h-%p.socket' -o ControlPersist=600"
+
+
+def run(argv: list[str], stdin=None, stdout=None) -> int:
+    """Execute a command directly (without a shell), returning the exit status.
+    stdin and stdout may be open files to redirect the command's I/O.
+    """
+    sys.stderr.write(shlex.join(argv) + '\n')
+    # flush our buffered output so that it appears before the command's output.
+    sys.stdout.flush()
+    sys.stderr.flush()
+    status = subprocess.run(argv, stdin=stdin, stdout=stdout).returncode
+    return status
+
+
+def compile_file(c_fname: str, flags: set, options: dict, cc: str, target: targets.Target, exec_cc: bool = False, unique_temps: bool = False) -> int:
+    """Compile a single C file, returning the exit status.
+    Note: this may run in a worker process, so the target is passed in
+    explicitly rather than relying on inherited module state.
+    If exec_cc is set, a local final compile replaces this process.
+    If unique_temps is set, the temporary files are named uniquely per input
+    path (see temp_fname), as other inputs are being compiled alongside it.
+    """
+    targets.current_target = target
+
+    # split the input filename once, up front.
+    noext = os.path.splitext(c_fname)[0]  # /foo/bar.c -> /foo/bar
+    stem = basename(noext)  # /foo/bar.c -> bar
+
+    # preprocess the input, unless there is nothing for the preprocessor to
+    # do, in which case we save a fork and parse the input directly.
+    # note: we invoke the compiler directly rather than via a shell, which
+    # saves a fork and copes with spaces in filenames.
+    cc_argv = shlex.split(cc)
+    if needs_preprocessing(c_fname):
+        i_fname = temp_fname(c_fname, stem, ".i", unique_temps)
+        status = run(cc_argv + ["-E", "-P", c_fname, "-o", i_fname])
+        if status != 0:
+            return status
+    else:
+        i_fname = c_fname
+
+    indent=3
+    if '--indent' in options:
+        indent = int(options['--indent'])
+
+    # parse the input.
+    from jpcc import pycp_to_c
+    if '--lex' in flags or '--parse' in flags:
+        # stop after lexing (or parsing).
+        pycp_to_c.parse(i_fname)
+        return 0
+    if '--c-ast' in flags or '--fold-constants' in flags:
+        # build the C AST.
+        c_ast = pycp_to_c.parse(i_fname)
+        if '--c-ast' in flags:
+            # dump the C AST and exit.
+            from jpcc import serialization
+            print(serialization.to_exprs_str(c_ast, indent=indent))
+            return 0
+        # translate C into TAC.
+        from jpcc import c_to_tac
+        tac_ast = c_to_tac.c_to_tac(c_ast, fold_constants='--fold-constants' in flags)
+    else:
+        # nothing needs the C AST, so translate straight into TAC.
+        tac_ast = pycp_to_c.parse_to_tac(i_fname)
+    if '--tac-ast' in flags:
+        # dump the TAC AST and exit.
+        from jpcc import serialization
+        print(serialization.to_exprs_str(tac_ast, indent=indent))
+        return 0
+    if '--tacky' in flags:
+        # stop after converting C to TACKY.
+        return 0
+
+    # generate assembly.
+    from jpcc import amd64
+    from jpcc import tac_to_amd64
+    amd64.emit_comments = '--no-comments' not in flags
+    amd64.emit_default_comments = '--no-default-comments' not in flags
+    if '--asm-ast' in flags or '--regalloc' in flags or '--peephole' in flags:
+        asm_ast = tac_to_amd64.gen_Program(tac_ast, optimize='--regalloc' in flags)
+        if '--peephole' in flags:
+            # clean up the generated assembly.
+            from jpcc import peephole
+            asm_ast = peephole.optimize(asm_ast)
+        if '--asm-ast' in flags:
+            # dump the ASM AST and exit.
+            from jpcc import serialization
+            print(serialization.to_exprs_str(asm_ast, indent=indent))
+            return 0
+        write_asm = asm_ast.write
+    else:
+        # nothing needs the ASM AST, so emit the assembly straight from TAC.
+        asm_fragments = []
+        tac_to_amd64.emit_Program(tac_ast, asm_fragments)
+        def write_asm(fd) -> None:
+            fd.writelines(asm_fragments)
+    if '-S' in flags and '-o' in options:
+        s_fname = options['-o']
+    else:
+        s_fname = temp_fname(c_fname, stem, ".s", unique_temps)
+    if s_fname == '-':
+        write_asm(sys.stdout)
+    else:
+        with open(s_fname, 'w') as fd:
+            write_asm(fd)
+            sys.stderr.write(f"Wrote: {s_fname}\n")
+    if '--codegen' in flags or '-S' in flags:
+        # stop after codegen.
+        return 0
+
+    # use gcc to compile the assembly to machine code.
+    # note: test_compiler expects the output binary to
+    # be the basename of the .c file, in the same directory.
+    # so 'cc /foo/bar.c' should produce '/foo/bar'.
+    c_flag = '-c' if '-c' in flags else ''
+    if '-o' in options:
+        bin_fname = options['-o']
+    else:
+        bin_fname = noext
+        if '-c' in flags:
+            bin_fname += '.o'
+    cc_flags = f"{c_flag}"
+    envarname = f"JPCC_{targets.current_target}_SSH_HOST"
+    if envarname in os.environ:
+        # use SSH to run gcc on a remote host.
+        # note: we multiplex all of our ssh invocations over a persistent
+        # master connection, which greatly improves performance when running
+        # lots of tests (this is equivalent to the following ~/.ssh/config):
+        #   Host *
+        #       ControlMaster auto
+        #       ControlPath  ~/.ssh/%r@%h-%p.socket
+        #       ControlPersist  600
+
+        host = os.environ[envarname]
+        sys.stderr.write(f"{envarname}: {host}\n")
+
+        remote_cc = "gcc"
+        envarname = f"JPCC_{targets.current_target}_SSH_CC"
+        if envarname in os.environ:
+            remote_cc = os.environ[envarname]
+            sys.stderr.write(f"{envarname}: {remote_cc}\n")
+
+        remote_s_fname = f"/tmp/{basename(s_fname)}"
+        # note: named after the (unique) assembly file, rather than the binary,
+        # so that concurrent compiles of same-named inputs can't collide.
+        remote_bin_fname = os.path.splitext(remote_s_fname)[0]
+        if bin_fname.endswith('.o'):
+            remote_bin_fname += '.o'
+
+        # stream the assembly file to the remote host and invoke the compiler
+        # there, all in a single round trip.
+        remote_cmdline = f"cat > {remote_s_fname} && cd /tmp && {remote_cc} {cc_flags} -o {remote_bin_fname} {remote_s_fname}"
+
+        # if this was a .o, stream it back to localhost over the same channel.
+        ssh_argv = ["ssh", *shlex.split(ssh_opts), host]
+        if bin_fname.endswith('.o'):
+            remote_cmdline += f" && cat {remote_bin_fname}"
+            with open(s_fname, 'rb') as s_fd, open(bin_fname, 'wb') as bin_fd:
+                status = run(ssh_argv + [remote_cmdline], stdin=s_fd, stdout=bin_fd)
+            if status != 0 and os.path.exists(bin_fname):
+                # don't leave a truncated .o behind.
+                os.remove(bin_fname)
+            return status
+        # if this was an executable, create a wrapper script to invoke it remotely.
+        else:
+            with open(s_fname, 'rb') as s_fd:
+                status = run(ssh_argv + [remote_cmdline], stdin=s_fd)
+            if status != 0: return status
+            with open(bin_fname, "w") as fd:
+                script = f"""#!/bin/bash
+set -e
+ssh {ssh_opts} {host} "{remote_bin_fname} \\"$@\\""
+"""
+                fd.write(script)
+            os.chmod(bin_fname, 0o755)
+            return 0
+
+    else:
+        # assume localhost is the correct target and run gcc locally.
+        argv = cc_argv + ([c_flag] if c_flag else []) + ["-o", bin_fname, s_fname]
+        if exec_cc:
+            # there is nothing left for us to do, so rather than waiting on
+            # a child process, replace ourselves with the compiler.
+            sys.stderr.write(shlex.join(argv) + '\n')
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.execvp(argv[0], argv)
+        status = run(argv)
+        return status
@@ -0,0 +1,259 @@
+# This file implements a peephole optimizer for the chapter 2 ASM AST.
+# See "Writing a C Compiler" by Nora Sandler.
+
+# Our codegen pretends that amd64 is a load/store architecture, so each TAC
+# instruction loads its operand into a scratch register, operates on it, and
+# stores it back to the stack. For return-comp-neg-2.c that gives us:
+#
+#   movl $2, %r11d          # Load.
+#   negl %r11d              # Negate %r11d.
+#   movl %r11d, -8(%rbp)    # Store.
+#   movl -8(%rbp), %r11d    # Load.
+#   notl %r11d              # Flip all of the bits of %r11d.
+#   movl %r11d, -16(%rbp)   # Store.
+#   movl -16(%rbp), %eax    # Use -16(%rbp) as the return value.
+#
+# The peephole optimizer runs under --peephole (or -O1). With --regalloc,
+# temporaries are already in registers, so mostly the stack frame is left
+# to clean up. It repeatedly scans a small window of instructions, rewriting
+# known patterns into cheaper equivalents until none apply:
+#
+#   movl %r11d, -8(%rbp)    (reload: the register already holds the value,
+#   movl -8(%rbp), %r11d    -> deleted       even across instructions which
+#                                            change neither of them)
+#
+#   movl %r11d, -16(%rbp)   (forward a store to a following load)
+#   movl -16(%rbp), %eax    -> movl %r11d, %eax
+#
+#   movl %r11d, -8(%rbp)    (dead store: the slot is never read again)
+#                           -> deleted
+#
+#   movl x, %r11d           (copy through a dead scratch register)
+#   movl %r11d, y           -> movl x, y
+#
+#   movl x, x               (self-move) -> deleted
+#
+#   subq $8, %rsp           (combine stack adjustments)
+#   subq $16, %rsp          -> subq $24, %rsp
+#
+#   subq $16, %rsp          (unused stack: the rest of the function no longer
+#                            touches any stack slot) -> deleted
+#
+#   movq %rsp, %rbp         (redundant teardown: the function allocated
+#   ...                      nothing on the stack, so %rsp is unchanged)
+#   movq %rbp, %rsp         -> deleted
+#
+# which reduces the above to:
+#
+#   movl $2, %r11d
+#   negl %r11d
+#   notl %r11d
+#   movl %r11d, %eax
+
+from jpcc import amd64
+
+
+# the registers whose values never escape the function: codegen's scratch
+# registers, and the caller-saved registers handed out by regalloc.py.
+_scratch_registers = (
+    amd64.Register.ECX, amd64.Register.EDX, amd64.Register.ESI, amd64.Register.EDI,
+    amd64.Register.R8D, amd64.Register.R9D, amd64.Register.R10D, amd64.Register.R11D,
+)
+
+
+def optimize(program: amd64.Program) -> amd64.Program:
+    "Return a copy of the program with the peephole optimizations applied."
+    return amd64.Program(run(program.statements))
+
+
+def run(statements: list[amd64.Statement]) -> list[amd64.Statement]:
+    "Apply the peephole rules to a list of statements until none apply."
+    statements = list(statements)
+    changed = True
+    while changed:
+        changed = False
+        i = 0
+        while i < len(statements):
+            for rule in _rules:
+                if rule(statements, i):
+                    changed = True
+                    break
+            else:
+                i += 1
+    return statements
+
+
+def _reads(stmt: amd64.Statement, operand: amd64.Operand) -> bool:
+    "Does this statement read the operand?"
+    if isinstance(stmt, amd64.Instruction1):
+        return stmt.arg == operand
+    if isinstance(stmt, amd64.Instruction2):
+        # note: movl only writes its destination, everything else reads it too.
+        return stmt.src == operand or (type(stmt) is not amd64.Movl and stmt.dst == operand)
+    return False
+
+
+def _writes(stmt: amd64.Statement, operand: amd64.Operand) -> bool:
+    "Does this statement (over)write the operand?"
+    if isinstance(stmt, amd64.Instruction1):
+        return stmt.arg == operand
+    if isinstance(stmt, amd64.Instruction2):
+        return stmt.dst == operand
+    return False
+
+
+def _is_live(statements: list[amd64.Statement], i: int, operand: amd64.Operand) -> bool:
+    "Might the value of the operand be read at or after statement i?"
+    for stmt in statements[i:]:
+        if isinstance(stmt, amd64.LabelDef):
+            # we can't see past a label (we don't know who jumps there).
+            return True
+        if _reads(stmt, operand):
+            return True
+        if _writes(stmt, operand):
+            return False
+    return False
+
+
+def _is_movl(stmt: amd64.Statement) -> bool:
+    return type(stmt) is amd64.Movl
+
+
+def _self_move(statements: list[amd64.Statement], i: int) -> bool:
+    "movl x, x -> (deleted)"
+    stmt = statements[i]
+    if _is_movl(stmt) and stmt.src == stmt.dst:
+        del statements[i]
+        return True
+    return False
+
+
+def _reload(statements: list[amd64.Statement], i: int) -> bool:
+    "movl %r, m; ...; movl m, %r -> movl %r, m; ..., if neither %r nor m changed"
+    store = statements[i]
+    if not (_is_movl(store) and isinstance(store.src, amd64.Register) \
+        and isinstance(store.dst, amd64.Stack)):
+        return False
+    # note: registers and stack slots are shared instances, so they can be
+    # compared by identity.
+    for j in range(i + 1, len(statements)):
+        stmt = statements[j]
+        if _is_movl(stmt) and stmt.src is store.dst and stmt.dst is store.src:
+            del statements[j]
+            return True
+        if isinstance(stmt, amd64.LabelDef) \
+            or _writes(stmt, store.src) or _writes(stmt, store.dst):
+            return False
+    return False
+
+
+def _forward_store(statements: list[amd64.Statement], i: int) -> bool:
+    "movl %r, m; movl m, %s -> movl %r, m; movl %r, %s"
+    if i + 1 >= len(statements):
+        return False
+    (store, load) = statements[i:i+2]
+    if _is_movl(store) and _is_movl(load) \
+        and isinstance(store.src, amd64.Register) \
+        and isinstance(store.dst, amd64.Stack) \
+        and load.src is store.dst and isinstance(load.dst, amd64.Register) \
+        and load.dst is not store.src:
+        # note: the load's comment may refer to the stack slot, so rather than
+        # keep it, we fall back to movl's default comment.
+        statements[i+1] = amd64.Movl(src=store.src, dst=load.dst)
+        return True
+    return False
+
+
+def _dead_store(statements: list[amd64.Statement], i: int) -> bool:
+    "movl x, m -> (deleted), if m is never read again"
+    stmt = statements[i]
+    if _is_movl(stmt) and isinstance(stmt.dst, amd64.Stack) \
+        and not _is_live(statements, i + 1, stmt.dst):
+        del statements[i]
+        return True
+    return False
+
+
+def _copy_through_scratch(statements: list[amd64.Statement], i: int) -> bool:
+    "movl x, %r11d; movl %r11d, y -> movl x, y, if %r11d is then dead"
+    if i + 1 >= len(statements):
+        return False
+    (first, second) = statements[i:i+2]
+    if _is_movl(first) and _is_movl(second) \
+        and first.dst in _scratch_registers and second.src is first.dst \
+        and second.dst is not first.dst \
+        and not (isinstance(first.src, amd64.Stack) and isinstance(second.dst, amd64.Stack)) \
+        and not _is_live(statements, i + 2, first.dst):
+        # note: amd64 has no memory-to-memory movl, hence the check above.
+        statements[i:i+2] = [amd64.Movl(src=first.src, dst=second.dst)]
+        return True
+    return False
+
+
+def _combine_subq(statements: list[amd64.Statement], i: int) -> bool:
+    "subq $a, x; subq $b, x -> subq $(a+b), x"
+    if i + 1 >= len(statements):
+        return False
+    (first, second) = statements[i:i+2]
+    if type(first) is amd64.Subq and type(second) is amd64.Subq \
+        and isinstance(first.src, amd64.Imm) and isinstance(second.src, amd64.Imm) \
+        and first.dst == second.dst:
+        src = amd64.imm(first.src.value + second.src.value)
+        statements[i:i+2] = [amd64.Subq(src=src, dst=first.dst)]
+        return True
+    return False
+
+
+def _unused_stack(statements: list[amd64.Statement], i: int) -> bool:
+    "subq $n, %rsp -> (deleted), if the rest of the function uses no stack slot"
+    stmt = statements[i]
+    if not (type(stmt) is amd64.Subq and stmt.dst is amd64.Register.RSP):
+        return False
+    for later in statements[i+1:]:
+        if type(later) is amd64.Directive:
+            # the start of the next function.
+            break
+        if _uses_stack(later):
+            return False
+    del statements[i]
+    return True
+
+
+def _uses_stack(stmt: amd64.Statement) -> bool:
+    "Does this statement read or write a stack slot?"
+    if isinstance(stmt, amd64.Instruction1):
+        return type(stmt.arg) is amd64.Stack
+    if isinstance(stmt, amd64.Instruction2):
+        return type(stmt.src) is amd64.Stack or type(stmt.dst) is amd64.Stack
+    return False
+
+
+def _redundant_teardown(statements: list[amd64.Statement], i: int) -> bool:
+    "movq %rsp, %rbp; ...; movq %rbp, %rsp -> movq %rsp, %rbp; ..., if neither changed"
+    setup = statements[i]
+    rsp = amd64.Register.RSP
+    rbp = amd64.Register.RBP
+    if not (type(setup) is amd64.Movq and setup.src is rsp and setup.dst is rbp):
+        return False
+    for j in range(i + 1, len(statements)):
+        stmt = statements[j]
+        if type(stmt) is amd64.Movq and stmt.src is rbp and stmt.dst is rsp:
+            del statements[j]
+            return True
+        # note: pushq and popq (and call/ret) move %rsp implicitly.
+        if isinstance(stmt, (amd64.LabelDef, amd64.Instruction0, amd64.Pushq, amd64.Popq)) \
+            or _writes(stmt, rsp) or _writes(stmt, rbp):
+            return False
+    return False
+
+
+_rules = [
+    _self_move,
+    _reload,
+    _forward_store,
+    _dead_store,
+    _copy_through_scratch,
+    _combine_subq,
+    _unused_stack,
+    _redundant_teardown,
+]
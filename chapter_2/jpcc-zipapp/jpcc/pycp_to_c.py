@@ -2,6 +2,12 @@
 # See "Writing a C Compiler" by Nora Sandler.
 
 import sys
+import os
+import hashlib
+import pickle
+import tempfile
+import threading
+import itertools
 from dataclasses import dataclass
 
 try:
@@ -65,68 +71,257 @@ except:
 
 
 from jpcc import c
+from jpcc import tac
+from jpcc import c_to_tac
 
-def _c_pycp_ast(fname: str) -> pycparser.c_ast.Node:
-    "Use pycparser to parse a C file, returning the AST."
-    c_ast = pycparser.parse_file(fname, use_cpp=False)
+
+_thread_local = threading.local()
+
+def _get_parser() -> pycparser.CParser:
+    "Return this thread's pycparser parser, creating it on first use."
+    # note: pycparser.parse_file() constructs a new CParser (and reloads its
+    # lexer and LALR tables) on every call, so we hold on to one.
+    # note: a CParser keeps its parse state on itself, so it isn't safe to
+    # share between threads (remote compiles run on a thread pool).
+    parser = getattr(_thread_local, "parser", None)
+    if parser is None:
+        parser = pycparser.CParser()
+        _thread_local.parser = parser
+    return parser
+
+
+def _c_pycp_ast(fname: str, text: str) -> pycparser.c_ast.Node:
+    "Use pycparser to parse the text of a C file, returning the AST."
+    c_ast = _get_parser().parse(text, fname)
     return c_ast
 
 
 def _pycp_ast_to_ch2_ast(c_ast: pycparser.c_ast.Node) -> c.C_AST:
     "Translate a pycparser AST into a chapter 2 C AST."
-    return _translate_FileAST(c_ast)
+    # note: nodes are only shared within a single translation (see
+    # _translate_expr), so that a long-lived process (or a worker compiling
+    # many files) doesn't accumulate them, and threads don't share a table.
+    shared = {}
+    return _translate_FileAST(c_ast, shared)
 
 
-def _translate_FileAST(c_ast: pycparser.c_ast.FileAST) -> c.Program:
-    assert isinstance(c_ast, pycparser.c_ast.FileAST)
-    funcdef = _translate_FuncDef(c_ast.ext[0])
+# Note: the type assertions below only guard against unsupported input
+# (e.g. a declaration where we expect a function definition). They use
+# 'type() is' rather than isinstance() to avoid walking the MRO, and are
+# omitted entirely where the caller has already dispatched on type.
+
+def _translate_FileAST(c_ast: pycparser.c_ast.FileAST, shared: dict) -> c.Program:
+    funcdef = _translate_FuncDef(c_ast.ext[0], shared)
     return c.Program(funcdef)
 
 
-def _translate_FuncDef(c_ast: pycparser.c_ast.FuncDef) -> c.Function:
-    assert isinstance(c_ast, pycparser.c_ast.FuncDef)
-    assert isinstance(c_ast.body, pycparser.c_ast.Compound)
+def _translate_FuncDef(c_ast: pycparser.c_ast.FuncDef, shared: dict) -> c.Function:
+    assert type(c_ast) is pycparser.c_ast.FuncDef
+    assert type(c_ast.body) is pycparser.c_ast.Compound
     assert len(c_ast.body.block_items) == 1
-    name = c_ast.decl.name
-    body = _translate_Return(c_ast.body.block_items[0])
+    # note: identifiers are interned, so that later passes which compare or
+    # hash them (e.g. as symbol table keys) can do so by pointer.
+    name = sys.intern(c_ast.decl.name)
+    body = _translate_Return(c_ast.body.block_items[0], shared)
     return c.Function(name, body)
 
 
-def _translate_expr(c_ast: pycparser.c_ast.Node) -> c.C_AST:
-    match type(c_ast):
-        case pycparser.c_ast.UnaryOp:
-            return _translate_UnaryOp(c_ast)
-        case pycparser.c_ast.Constant:
-            return _translate_Constant(c_ast)
-        case _:
-            raise Exception(f"Unsupported expression {c_ast}")
-
+def _translate_expr(c_ast: pycparser.c_ast.Node, shared: dict) -> c.C_AST:
+    # note: C AST nodes are immutable, so structurally identical
+    # subexpressions can share a single instance. 'shared' maps each constant
+    # value, and each (op, id(operand)) pair, to its node. Operands are
+    # already shared, and the table keeps them alive, so their ids are stable.
+    # note: rather than recursing once per nesting level, walk down the
+    # chain of unary operators to the operand, then wrap it back up.
+    UnaryOp = pycparser.c_ast.UnaryOp
+    unary_ops = _unary_ops
+    ops = []
+    while type(c_ast) is UnaryOp:
+        op = unary_ops.get(c_ast.op)
+        if op is None:
+            raise Exception(f"Unsupported UnaryOp '{c_ast.op}'")
+        ops.append(op)
+        c_ast = c_ast.expr
+    translate_fn = _operand_translators.get(type(c_ast))
+    if translate_fn is None:
+        raise Exception(f"Unsupported expression {c_ast}")
+    expr = translate_fn(c_ast, shared)
+    Unary = c.Unary
+    for op in reversed(ops):
+        key = (op, id(expr))
+        node = shared.get(key)
+        if node is None:
+            node = Unary(op, expr)
+            shared[key] = node
+        expr = node
+    return expr
 
-def _translate_UnaryOp(c_ast: pycparser.c_ast.UnaryOp) -> c.Unary:
-    assert isinstance(c_ast, pycparser.c_ast.UnaryOp)
-    match c_ast.op:
-        case "-": op = c.Negate()
-        case "~": op = c.Complement()
-        case _: raise Exception(f"Unsupported UnaryOp '{c_ast.op}'")
-    expr = _translate_expr(c_ast.expr)
-    return c.Unary(op, expr)
 
-
-def _translate_Return(c_ast: pycparser.c_ast.Return) -> c.Return:
-    assert isinstance(c_ast, pycparser.c_ast.Return)
-    expr = _translate_expr(c_ast.expr)
+def _translate_Return(c_ast: pycparser.c_ast.Return, shared: dict) -> c.Return:
+    assert type(c_ast) is pycparser.c_ast.Return
+    expr = _translate_expr(c_ast.expr, shared)
     return c.Return(expr)
 
 
-def _translate_Constant(c_ast: pycparser.c_ast.Constant) -> c.Constant:
-    assert isinstance(c_ast, pycparser.c_ast.Constant)
+def _translate_Constant(c_ast: pycparser.c_ast.Constant, shared: dict) -> c.Constant:
     assert c_ast.type == "int"
     value = int(c_ast.value)
-    return c.Constant(value)
+    node = shared.get(value)
+    if node is None:
+        node = c.Constant(value)
+        shared[value] = node
+    return node
+
+
+# When the C AST itself isn't needed, we can skip building it, and instead
+# translate the pycparser AST straight into TAC, e.g.:
+#   Return(UnaryOp('~', UnaryOp('-', Constant(2))))
+# becomes:
+#   Unary(Negate, Constant(2), Var("tmp0"))
+#   Unary(Complement, Var("tmp0"), Var("tmp1"))
+#   Return(Var("tmp1"))
+# note: the instructions themselves are emitted by c_to_tac.unaries_to_tac,
+# so this produces the same TAC as c_to_tac.c_to_tac() would.
+
+def _pycp_ast_to_tac(c_ast: pycparser.c_ast.FileAST) -> tac.Program:
+    "Translate a pycparser AST directly into a TAC AST."
+    funcdef = c_ast.ext[0]
+    assert type(funcdef) is pycparser.c_ast.FuncDef
+    assert type(funcdef.body) is pycparser.c_ast.Compound
+    assert len(funcdef.body.block_items) == 1
+    ret = funcdef.body.block_items[0]
+    assert type(ret) is pycparser.c_ast.Return
+    # walk down the chain of unary operators to the operand.
+    expr = ret.expr
+    ops = []
+    while type(expr) is pycparser.c_ast.UnaryOp:
+        op = _tac_unary_ops.get(expr.op)
+        if op is None:
+            raise Exception(f"Unsupported UnaryOp '{expr.op}'")
+        ops.append(op)
+        expr = expr.expr
+    if type(expr) is not pycparser.c_ast.Constant:
+        raise Exception(f"Unsupported expression {expr}")
+    assert expr.type == "int"
+    src = c_to_tac.make_constant(int(expr.value))
+    next_tmp = itertools.count().__next__
+    (body, val) = c_to_tac.unaries_to_tac(ops, src, next_tmp)
+    body.append(tac.Return(val))
+    return tac.Program(tac.Function(sys.intern(funcdef.decl.name), body))
+
+
+_tac_unary_ops = {
+    "-": tac.NEGATE,
+    "~": tac.COMPLEMENT,
+}
+
+
+# jump tables, keyed by pycparser node type and by operator string.
+_operand_translators = {
+    pycparser.c_ast.Constant: _translate_Constant,
+}
+_unary_ops = {
+    "-": c.NEGATE,
+    "~": c.COMPLEMENT,
+}
+
+
+# Parsed ASTs are cached (in memory, and pickled to disk) keyed by a hash of
+# the source text, so re-compiling an unchanged file skips pycparser entirely.
+# The key also covers our own code, and the pycparser and python versions,
+# so that changing the translator, the AST classes, or upgrading either of
+# those invalidates any stale entries.
+# C and TAC ASTs for the same source are cached separately.
+
+_ast_cache = {}
+_code_digest = None
+
+
+def _cache_dir() -> str:
+    "Return the on-disk AST cache directory, or None if disabled."
+    if "JPCC_CACHE_DIR" in os.environ:
+        return os.environ["JPCC_CACHE_DIR"] or None
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(cache_home, "jpcc")
+
+
+def _versions() -> bytes:
+    "Return the versions of pycparser and python, which also key the cache."
+    # note: pickles of our (slotted) AST classes are sensitive to the python
+    # version, and a pycparser upgrade may parse the same source differently.
+    return f"{pycparser.__version__} {sys.version_info[:2]}".encode()
+
+
+def _cache_key(data: bytes) -> str:
+    "Return the cache key for the given C source."
+    global _code_digest
+    if _code_digest is None:
+        h = hashlib.blake2b(digest_size=16)
+        for module in (c, tac, c_to_tac, sys.modules[__name__]):
+            h.update(module.__loader__.get_data(module.__file__))
+        h.update(_versions())
+        _code_digest = h.digest()
+    h = hashlib.blake2b(_code_digest, digest_size=16)
+    h.update(data)
+    return h.hexdigest()
+
+
+def _cache_load(key: str) -> c.C_AST:
+    "Load a cached AST from disk, returning None on a cache miss."
+    cache_dir = _cache_dir()
+    if cache_dir is None:
+        return None
+    try:
+        with open(os.path.join(cache_dir, key + ".pickle"), "rb") as fd:
+            return pickle.load(fd)
+    except Exception:
+        return None
+
+
+def _cache_store(key: str, ast: c.C_AST) -> None:
+    "Store an AST in the on-disk cache (best effort)."
+    cache_dir = _cache_dir()
+    if cache_dir is None:
+        return
+    tmp_fname = None
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        # write to a temp file and rename, so that concurrent compiles never
+        # observe a partially-written entry.
+        (fd, tmp_fname) = tempfile.mkstemp(dir=cache_dir)
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(ast, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_fname, os.path.join(cache_dir, key + ".pickle"))
+    except Exception:
+        # don't leave the temp file behind in the cache dir.
+        if tmp_fname is not None:
+            try:
+                os.unlink(tmp_fname)
+            except OSError:
+                pass
+
+
+def _parse_cached(fname: str, kind: str, translate_fn) -> object:
+    "Parse a C file and translate it with translate_fn, using the cache."
+    with open(fname, "rb") as fd:
+        data = fd.read()
+    key = f"{_cache_key(data)}-{kind}"
+    ast = _ast_cache.get(key)
+    if ast is None:
+        ast = _cache_load(key)
+    if ast is None:
+        pycp_ast = _c_pycp_ast(fname, data.decode())
+        ast = translate_fn(pycp_ast)
+        _cache_store(key, ast)
+    _ast_cache[key] = ast
+    return ast
 
 
 def parse(fname: str) -> c.C_AST:
     "Parse a C file and return the chapter 2 C AST."
-    pycp_ast = _c_pycp_ast(fname)
-    ch2_ast = _pycp_ast_to_ch2_ast(pycp_ast)
-    return ch2_ast
+    return _parse_cached(fname, "c", _pycp_ast_to_ch2_ast)
+
+
+def parse_to_tac(fname: str) -> tac.Program:
+    "Parse a C file and return its TAC AST, without building a C AST."
+    return _parse_cached(fname, "tac", _pycp_ast_to_tac)
@@ -0,0 +1,119 @@
+# This file implements a linear scan register allocator for chapter 2 TAC.
+# See "Linear Scan Register Allocation" by Poletto and Sarkar.
+
+# Our TAC is already in SSA form: each temporary is assigned exactly once (by
+# the instruction which defines it), so its live interval is simply the span
+# from that instruction to the last instruction which uses it. e.g. for:
+#
+#   0: Unary(Negate, Constant(2), Var("tmp0"))
+#   1: Unary(Complement, Var("tmp0"), Var("tmp1"))
+#   2: Return(Var("tmp1"))
+#
+# the live intervals are:
+#
+#   tmp0: [0, 1]
+#   tmp1: [1, 2]
+#
+# Linear scan walks the intervals in order of their start, handing each one a
+# free register, and reclaiming the registers of any intervals which have
+# ended. When no register is free, whichever interval ends last is spilled
+# (i.e. left to live on the stack). Above, tmp0's interval ends where tmp1's
+# begins, so both get the same register:
+#
+#   tmp0: %ecx
+#   tmp1: %ecx
+#
+# Additionally, a returned temporary is placed directly in %eax (when %eax
+# isn't already holding another one), which saves copying it there. So is
+# any temporary whose last use is to compute one of those, so that a chain
+# of unary operations is computed in place, without copying between them:
+#
+#   tmp0: %eax
+#   tmp1: %eax
+#
+# e.g. 'jpcc --regalloc -S' on 'return -(~(-(~(-(~(7))))));' computes the whole
+# chain in %eax, without any copies or stack traffic.
+
+from jpcc import tac
+from jpcc import amd64
+
+
+# The registers available to the allocator.
+# note: these are all caller-saved, so the function doesn't need to preserve
+# them. %eax is reserved for the return value, and %r11d is the scratch
+# register codegen uses for spilled temporaries.
+_registers = (
+    amd64.Register.ECX, amd64.Register.EDX, amd64.Register.ESI, amd64.Register.EDI,
+    amd64.Register.R8D, amd64.Register.R9D, amd64.Register.R10D,
+)
+
+
+def _live_intervals(body: list[tac.Instruction]) -> dict[str, list[int]]:
+    "Return the [start, end] instruction index interval of each Var, in order of start."
+    intervals = {}
+    for (i, inst) in enumerate(body):
+        match inst:
+            case tac.Unary(_, src, dst):
+                if type(src) is tac.Var:
+                    intervals[src.name][1] = i
+                intervals[dst.name] = [i, i]
+            case tac.Return(val):
+                if type(val) is tac.Var:
+                    intervals[val.name][1] = i
+            case _:
+                raise Exception(f"Unsupported instruction {inst}")
+    return intervals
+
+
+def _wants_eax(body: list[tac.Instruction], intervals: dict[str, list[int]]) -> set[str]:
+    "Return the names of the Vars which should be placed in %eax."
+    wants_eax = set()
+    # note: walk backwards, so that each Unary's dst has been decided before its src.
+    for i in range(len(body) - 1, -1, -1):
+        inst = body[i]
+        if type(inst) is tac.Return:
+            if type(inst.val) is tac.Var:
+                wants_eax.add(inst.val.name)
+        elif type(inst.src) is tac.Var and inst.dst.name in wants_eax \
+            and intervals[inst.src.name][1] == i:
+            wants_eax.add(inst.src.name)
+    return wants_eax
+
+
+def allocate(body: list[tac.Instruction], registers: tuple = _registers) -> dict[str, amd64.Register]:
+    "Assign registers to the Vars of a function body, omitting any which are spilled."
+    allocation = {}
+    # note: free is used as a stack, so a just-released register is reused
+    # first (which lets a Unary's dst share its src's register).
+    free = list(reversed(registers))
+    active = []  # the (end, name) of each interval currently holding a register.
+    intervals = _live_intervals(body)
+    wants_eax = _wants_eax(body, intervals)
+    eax_free_from = 0  # the index from which %eax is available.
+    for (name, (start, end)) in intervals.items():
+        if name in wants_eax and eax_free_from <= start:
+            allocation[name] = amd64.Register.EAX
+            eax_free_from = end
+            continue
+        # release the registers of intervals which have ended.
+        # note: an interval which ends here can share its register with one
+        # which starts here, as the instruction reads its src before writing
+        # its dst.
+        still_active = []
+        for (active_end, active_name) in active:
+            if active_end <= start:
+                free.append(allocation[active_name])
+            else:
+                still_active.append((active_end, active_name))
+        active = still_active
+        if len(free) > 0:
+            allocation[name] = free.pop()
+            active.append((end, name))
+            continue
+        # no register is free, so spill whichever interval ends last.
+        (spill_end, spill_name) = max(active, default=(end, name))
+        if spill_end > end:
+            allocation[name] = allocation.pop(spill_name)
+            active.remove((spill_end, spill_name))
+            active.append((end, name))
+    return allocation
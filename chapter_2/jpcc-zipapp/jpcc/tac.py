@@ -24,48 +24,63 @@ from dataclasses import dataclass
 #   UnaryOperator > Complement | Negate
 
 
-class TAC_AST: pass
+# note: AST nodes compare (and hash) by identity: nothing needs value
+# equality, and each Var is a single instance shared by its definition and
+# all of its uses.
 
 
-class Operand(TAC_AST):  pass
+class TAC_AST: __slots__ = ()
 
 
-@dataclass
+class Operand(TAC_AST): __slots__ = ()
+
+
+@dataclass(slots=True, frozen=True, eq=False)
 class Constant(Operand):
     value: int
 
 
-@dataclass
+@dataclass(slots=True, frozen=True, eq=False)
 class Var(Operand):
     name: str
 
 
-class Instruction(TAC_AST): pass
+class Instruction(TAC_AST): __slots__ = ()
+
+
+class UnaryOperator(TAC_AST):
+    __slots__ = ()
+
+    def __reduce__(self):
+        "Unpickle as the shared instance (e.g. NEGATE) rather than a copy."
+        return self.__class__.__name__.upper()
 
+class Complement(UnaryOperator): __slots__ = ()
+class Negate(UnaryOperator): __slots__ = ()
 
-class UnaryOperator(TAC_AST): pass
-class Complement(UnaryOperator): pass
-class Negate(UnaryOperator): pass
+# the unary operators carry no state, so share a single instance of each.
+COMPLEMENT = Complement()
+NEGATE = Negate()
 
 
-@dataclass
+@dataclass(slots=True, frozen=True, eq=False)
 class Unary(Instruction):
     op: UnaryOperator
     src: Operand
     dst: Operand
 
 
-@dataclass
+@dataclass(slots=True, frozen=True, eq=False)
 class Return(Instruction):
     val: Operand
 
 
-@dataclass
+@dataclass(slots=True, frozen=True, eq=False)
 class Function(TAC_AST):
     name: str
     body: list[Instruction]
 
 
-@dataclass
+@dataclass(slots=True, frozen=True, eq=False)
 class Program(TAC_AST):
     funcdef: Function
@@ -1,7 +1,7 @@
 # This file translates a chapter 2 TAC AST into a ASM AST and emits GAS-syntax assembly.
 
 from __future__ import annotations
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 
 # So for return-comp-neg-2.c:
 #
@@ -65,8 +65,8 @@ from dataclasses import dataclass
 #            comment "Start a new stack frame."
 #         )
 #         (Subq
-#            src (Stack
-#               offset -16
+#            src (Imm
+#               value 16
 #            )
 #            dst (RSP)
 #            comment "Allocate 16 bytes on the stack for locals."
@@ -136,7 +136,7 @@ from dataclasses import dataclass
 #   _main:                          # Begin function main.
 #           pushq %rbp              # Save the caller's base pointer.
 #           movq %rsp, %rbp         # Start a new stack frame.
-#           subq -16(%rbp), %rsp    # Allocate 16 bytes on the stack for locals.
+#           subq $16, %rsp          # Allocate 16 bytes on the stack for locals.
 #           movl $2, %r11d          # Load.
 #           negl %r11d              # Negate %r11d.
 #           movl %r11d, -8(%rbp)    # Store.
@@ -152,6 +152,16 @@ from dataclasses import dataclass
 # Note that my ASM generation approach diverges from the book:
 # - I pretend that amd64 is a "load/store" architecture.
 
+# With --regalloc, temporaries are instead assigned registers where possible
+# (see regalloc.py), only spilled temporaries live on the stack, and
+# instructions are selected from a table of patterns (see _patterns below).
+# A returned temporary is placed straight in %eax, so _gen_Return needs no
+# copy, e.g.
+# 'jpcc --regalloc -S' on 'return ~(-2);' emits:
+#           movl $2, %eax
+#           negl %eax
+#           notl %eax
+
 # Note: 'GAS' (GNU as) syntax is:
 #   instruction source, destination
 # e.g. this copies %rsp into %rbp:
@@ -161,131 +171,273 @@ from dataclasses import dataclass
 from jpcc import tac
 from jpcc import amd64
 
-def _lowest_offset(symbol_table: dict) -> int:
-    "Find the lowest offset in the symbol table."
-    lowest = 0
-    for k, v in symbol_table.items():
-        if v.offset < lowest:
-            lowest = v.offset
-    return lowest
+@dataclass(slots=True)
+class _SymbolTable:
+    "The Stack() locations of a function's temporaries."
+    locations: dict[str, amd64.Stack] = field(default_factory=dict)
+    # note: slots are handed out in order, so rather than scanning the table
+    # for the lowest offset, we keep track of it as we go.
+    lowest_offset: int = 0
+    # whether any temporary lives on the stack, i.e. whether the function
+    # needs to allocate (and tear down) any stack space.
+    uses_stack: bool = False
 
 
-def _get_symbol(symbol: str, symbol_table: dict):
+def _get_symbol(symbol: str, symbol_table: _SymbolTable):
     "Return the Stack() location of the symbol, adding it to the table if needed."
     assert isinstance(symbol, str), symbol
-    if symbol not in symbol_table:
-        lowest = _lowest_offset(symbol_table)
-        symbol_table[symbol] = amd64.Stack(lowest - 8)
-    return symbol_table[symbol]
+    location = symbol_table.locations.get(symbol)
+    if location is None:
+        symbol_table.lowest_offset -= 8
+        location = amd64.stack(symbol_table.lowest_offset)
+        symbol_table.locations[symbol] = location
+    return location
 
 
-def gen_Program(tac_ast: tac.Program) -> amd64.Program:
-    "Generate assembly for a tac.Program."
+def _get_location(var: tac.Var, registers: dict, symbol_table: _SymbolTable) -> amd64.Operand:
+    "Return the register allocated to the var, or else its Stack() location."
+    reg = registers.get(var.name)
+    if reg is not None:
+        return reg
+    return _get_symbol(var.name, symbol_table)
+
+
+def gen_Program(tac_ast: tac.Program, optimize: bool = False) -> amd64.Program:
+    "Generate assembly for a tac.Program, optionally allocating registers and selecting patterns."
     assert(isinstance(tac_ast, tac.Program))
+    statements = []
+    _gen_Function(tac_ast.funcdef, optimize, statements)
     asm_ast = amd64.Program(
-        statements = _gen_Function(tac_ast.funcdef)
+        statements = statements
     )
     return asm_ast
 
 
-def _gen_Function(tac_fn_ast: tac.Function) -> list[amd64.Statement]:
-    "Generate assembly for a tac.Function."
+# When nothing needs the ASM AST itself (e.g. we are just writing a .s file),
+# we can skip building it: each statement's assembly is emitted as soon as it
+# is generated, and the statement is then thrown away.
+
+def emit_Program(tac_ast: tac.Program, out: list[str]) -> None:
+    "Generate assembly for a tac.Program, appending its GAS fragments to out."
+    assert(isinstance(tac_ast, tac.Program))
+    writer = _StatementWriter(out)
+    _gen_Function(tac_ast.funcdef, False, writer)
+    writer.finish()
+
+
+class _StatementWriter:
+    "A stand-in for a list of statements, which emits each statement as it is appended."
+    __slots__ = ("out", "deferred")
+
+    def __init__(self, out: list[str]):
+        self.out = out
+        # statements which are still to be fixed up, and their index in out.
+        self.deferred = []
+
+    def append(self, statement: amd64.Statement) -> None:
+        if type(statement) is amd64.Comment and not amd64.emit_comments:
+            # rather than emit an empty line.
+            return
+        if isinstance(statement, amd64.Instruction2) and type(statement.src) is amd64.Fixup:
+            # leave a gap for it, to be filled in by finish().
+            self.deferred.append((len(self.out), statement))
+            self.out.append(None)
+            return
+        statement.emit(self.out)
+        self.out.append("\n")
+
+    def finish(self) -> None:
+        "Emit any fixed-up statements into their gaps."
+        # note: fill in the gaps from last to first, so that the indices of
+        # the remaining gaps stay valid.
+        for (i, statement) in reversed(self.deferred):
+            fragments = []
+            statement.emit(fragments)
+            fragments.append("\n")
+            self.out[i:i+1] = fragments
+        self.deferred.clear()
+
+
+def _gen_Function(tac_fn_ast: tac.Function, optimize: bool, statements: list[amd64.Statement]) -> None:
+    "Generate assembly for a tac.Function, appending it to statements."
     assert(isinstance(tac_fn_ast, tac.Function))
-    statements = []
     funcname = tac_fn_ast.name
-
-    # declare the function.
     funclabel = amd64.format_label(funcname)
-    statements += [
-        amd64.Directive(".globl", funclabel, f"Make {funclabel} externally visible."),
-        amd64.LabelDef(funcname, f"Begin function {funcname}.")
-    ]
-
+    allocate_stack = amd64.Subq(src=amd64.Fixup(), dst=amd64.Register.RSP, comment=amd64.Fixup())
+    # declare the function.
+    statements.append(amd64.Directive(".globl", funclabel, f"Make {funclabel} externally visible."))
+    statements.append(amd64.LabelDef(funcname, f"Begin function {funcname}."))
     # function prologue.
-    statements += [
-        amd64.Pushq(amd64.RBP(), "Save the caller's base pointer."),
-        amd64.Movq(src=amd64.RSP(), dst=amd64.RBP(), comment="Start a new stack frame."),
-    ]
-    allocate_stack = amd64.Subq(src=amd64.Fixup(), dst=amd64.RSP(), comment=amd64.Fixup())
-    statements.append(allocate_stack)
+    statements.append(amd64.Pushq(amd64.Register.RBP, "Save the caller's base pointer."))
+    statements.append(amd64.Movq(src=amd64.Register.RSP, dst=amd64.Register.RBP, comment="Start a new stack frame."))
 
-    # function body.
+    # decide where the temporaries live.
     assert(isinstance(tac_fn_ast.body, list))
-    symbol_table = {}
-    for tac_inst in tac_fn_ast.body:
-        statements += _gen_Instruction(tac_inst, symbol_table)
+    body = tac_fn_ast.body
+    if optimize:
+        from jpcc import regalloc
+        registers = regalloc.allocate(body)
+    else:
+        registers = {}
+    # note: every temporary is the dst of a Unary, so we can tell up front
+    # whether any of them will need a stack slot. If none do, we leave out
+    # the stack allocation (and the teardown in _gen_epilogue), rather than
+    # removing them afterwards, as emit_Program has already written them out
+    # by then.
+    symbol_table = _SymbolTable()
+    symbol_table.uses_stack = any(
+        type(inst) is tac.Unary and inst.dst.name not in registers for inst in body
+    )
+    if symbol_table.uses_stack:
+        statements.append(allocate_stack)
+
+    # function body.
+    # note: the generators below append their statements directly onto
+    # 'statements', rather than each returning a short-lived list.
+    if optimize:
+        _select_Instructions(body, registers, symbol_table, statements)
+    else:
+        # note: this is the hot loop, so rather than calling a helper per
+        # instruction, we dispatch on the jump table directly.
+        generators = _instruction_generators
+        for tac_inst in body:
+            gen_fn = generators.get(type(tac_inst))
+            if gen_fn is None:
+                raise Exception(f"Unreachable")
+            gen_fn(tac_inst, registers, symbol_table, statements)
 
     # fixup the stack allocation.
-    lowest = _lowest_offset(symbol_table)
-    allocate_stack.src = amd64.Stack(lowest)
+    lowest = symbol_table.lowest_offset
+    allocate_stack.src = amd64.imm(-lowest)
     allocate_stack.comment = f"Allocate {lowest * -1} bytes on the stack for locals."
 
-    statements += [amd64.Comment(f"End function {funcname}.")]
-    return statements
+    statements.append(amd64.Comment(f"End function {funcname}."))
 
 
-def _gen_Instruction(tac_ast: tac.Instruction, symbol_table: dict) -> list[amd64.Statement]:
-    "Generate assembly for a tac.Instruction."
-    assert isinstance(tac_ast, tac.Instruction)
-    statements = []
-    match tac_ast:
-        case tac.Unary():
-            return _gen_Unary(tac_ast, symbol_table)
-        case tac.Return():
-            return _gen_Return(tac_ast, symbol_table)
-        case _:
-            raise Exception(f"Unreachable")
-    return statements
+def _gen_Operand(tac_ast: tac.Operand, registers: dict, symbol_table: _SymbolTable) -> amd64.Operand:
+    "Generate the amd64 operand for a tac.Operand."
+    if type(tac_ast) is tac.Constant:
+        return amd64.imm(tac_ast.value)
+    if type(tac_ast) is tac.Var:
+        return _get_location(tac_ast, registers, symbol_table)
+    raise Exception(f"Unreachable")
 
 
-def _gen_Unary(tac_ast: tac.Unary, symbol_table: dict) -> list[amd64.Statement]:
-    "Generate assembly for a tac.Unary."
-    assert isinstance(tac_ast, tac.Unary)
-    statements = []
-    match tac_ast:
-        case tac.Unary(op, tac_src, tac_dst):
-            match tac_src:
-                case tac.Constant() as con:
-                    src = amd64.Imm(con.value)
-                case tac.Var() as var:
-                    src = _get_symbol(var.name, symbol_table)
-                case _:
-                    raise Exception(f"Unreachable")
-            dst = _get_symbol(tac_dst.name, symbol_table)
-            # pretend this is a load-store architecture.
-            # load the src into a register.
-            statements += [amd64.Movl(src=src, dst=amd64.R11D(), comment="Load.")]
-            # perform the unary operation on the register.
-            match op:
-                case tac.Complement():
-                    statements += [amd64.Notl(amd64.R11D())]
-                case tac.Negate():
-                    statements += [amd64.Negl(amd64.R11D())]
-                case _:
-                    raise Exception(f"Unreachable")
-            # store the register into dst.
-            statements += [amd64.Movl(src=amd64.R11D(), dst=dst, comment="Store.")]
-        case _:
-            raise Exception(f"Unreachable")
-    return statements
-
-
-def _gen_Return(tac_ast: tac.Return, symbol_table: dict) -> list[amd64.Statement]:
-    "Generate assembly for a tac.Return."
-    assert isinstance(tac_ast, tac.Return)
-    arg = tac_ast.val
-    assert isinstance(arg, tac.Operand)
-    match arg:
-        case tac.Constant() as con:
-            src = amd64.Imm(con.value)
-        case tac.Var() as var:
-            src = _get_symbol(var.name, symbol_table)
-        case _:
+def _gen_Unary(tac_ast: tac.Unary, registers: dict, symbol_table: _SymbolTable, statements: list[amd64.Statement]) -> None:
+    "Generate assembly for a tac.Unary, appending it to statements."
+    src = _gen_Operand(tac_ast.src, registers, symbol_table)
+    dst = _get_location(tac_ast.dst, registers, symbol_table)
+    append = statements.append
+    scratch = amd64.Register.R11D
+    # pretend this is a load-store architecture.
+    # load the src into a register.
+    append(amd64.Movl(src=src, dst=scratch, comment="Load."))
+    # perform the unary operation on the register.
+    append(_unary_instructions[type(tac_ast.op)](scratch))
+    # store the register into dst.
+    append(amd64.Movl(src=scratch, dst=dst, comment="Store."))
+
+
+def _gen_Return(tac_ast: tac.Return, registers: dict, symbol_table: _SymbolTable, statements: list[amd64.Statement]) -> None:
+    "Generate assembly for a tac.Return, appending it to statements."
+    src = _gen_Operand(tac_ast.val, registers, symbol_table)
+    if src is not amd64.Register.EAX:
+        # note: the register allocator may have already put it there.
+        statements.append(amd64.Movl(src=src, dst=amd64.Register.EAX, comment=f"Use {src.gas()} as the return value."))
+    _gen_epilogue(symbol_table, statements)
+
+
+# jump tables, keyed by TAC node type.
+_instruction_generators = {
+    tac.Unary: _gen_Unary,
+    tac.Return: _gen_Return,
+}
+_unary_instructions = {
+    tac.Complement: amd64.Notl,
+    tac.Negate: amd64.Negl,
+}
+
+
+def _gen_epilogue(symbol_table: _SymbolTable, statements: list[amd64.Statement]) -> None:
+    "Generate the function epilogue, appending it to statements."
+    if symbol_table.uses_stack:
+        statements.append(amd64.Movq(src=amd64.Register.RBP, dst=amd64.Register.RSP, comment="Tear down the stack frame."))
+    statements.append(amd64.Popq(amd64.Register.RBP, "Restore the caller's base pointer."))
+    statements.append(amd64.Ret(comment="Jump to the return address."))
+
+
+# Instruction selection (--regalloc):
+# Once temporaries live in registers, translating one TAC instruction at a
+# time through the scratch register is wasteful, so instead we pick from a
+# table of patterns, each of which covers a window of TAC instructions, e.g.:
+#   Unary(Negate, Constant(2), Var("tmp0"))    (tmp0 in %eax)
+# becomes:
+#   movl $2, %eax
+#   negl %eax
+# rather than a load, negl and store through %r11d.
+# Each entry is a (matcher, emitter, cost) tuple. The matcher returns how many
+# TAC instructions it covers at the given index (0 if it doesn't apply), and
+# the emitter appends the statements for them. We greedily pick whichever
+# matching pattern covers the most instructions, then whichever is cheapest
+# (in amd64 instructions).
+# note: there is no pattern for a unary of a constant: folding those is
+# --fold-constants' job (see c_to_tac.py).
+
+def _select_Instructions(body: list[tac.Instruction], registers: dict, symbol_table: _SymbolTable, statements: list[amd64.Statement]) -> None:
+    "Generate assembly for a function body by tiling it with _patterns."
+    i = 0
+    while i < len(body):
+        best = None
+        for (match_fn, emit_fn, cost) in _patterns:
+            count = match_fn(body, i, registers)
+            if count > 0 and (best is None or (count, -cost) > (best[0], -best[2])):
+                best = (count, emit_fn, cost)
+        if best is None:
             raise Exception(f"Unreachable")
-    statements = [
-        amd64.Movl(src=src, dst=amd64.EAX(), comment=f"Use {src.gas()} as the return value."),
-        amd64.Movq(src=amd64.RBP(), dst=amd64.RSP(), comment="Tear down the stack frame."),
-        amd64.Popq(amd64.RBP(), "Restore the caller's base pointer."),
-        amd64.Ret(comment="Jump to the return address."),
-    ]
-    return statements
+        (count, emit_fn, _) = best
+        emit_fn(body, i, registers, symbol_table, statements)
+        i += count
+
+
+def _match_unary_in_register(body: list[tac.Instruction], i: int, registers: dict) -> int:
+    "Unary(op, src, dst), where dst is in a register"
+    inst = body[i]
+    return 1 if type(inst) is tac.Unary and inst.dst.name in registers else 0
+
+
+def _emit_unary_in_register(body: list[tac.Instruction], i: int, registers: dict, symbol_table: _SymbolTable, statements: list[amd64.Statement]) -> None:
+    "movl src, %reg; (negl|notl) %reg"
+    inst = body[i]
+    src = _gen_Operand(inst.src, registers, symbol_table)
+    dst = registers[inst.dst.name]
+    # note: the register allocator may have put src in dst's register already.
+    if src is not dst:
+        statements.append(amd64.Movl(src=src, dst=dst))
+    statements.append(_unary_instructions[type(inst.op)](dst))
+
+
+def _match_unary(body: list[tac.Instruction], i: int, registers: dict) -> int:
+    "Unary(op, src, dst)"
+    return 1 if type(body[i]) is tac.Unary else 0
+
+
+def _emit_unary(body: list[tac.Instruction], i: int, registers: dict, symbol_table: _SymbolTable, statements: list[amd64.Statement]) -> None:
+    "movl src, %r11d; (negl|notl) %r11d; movl %r11d, dst"
+    _gen_Unary(body[i], registers, symbol_table, statements)
+
+
+def _match_return(body: list[tac.Instruction], i: int, registers: dict) -> int:
+    "Return(val)"
+    return 1 if type(body[i]) is tac.Return else 0
+
+
+def _emit_return(body: list[tac.Instruction], i: int, registers: dict, symbol_table: _SymbolTable, statements: list[amd64.Statement]) -> None:
+    "movl val, %eax; (epilogue)"
+    _gen_Return(body[i], registers, symbol_table, statements)
+
+
+_patterns = [
+    (_match_unary_in_register, _emit_unary_in_register, 2),
+    (_match_unary, _emit_unary, 3),
+    (_match_return, _emit_return, 1),
+]
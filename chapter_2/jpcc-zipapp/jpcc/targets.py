@@ -1,11 +1,10 @@
 # This file defines the supported compiler targets.
 
 from __future__ import annotations
-from dataclasses import dataclass
+from typing import NamedTuple
 
 
-@dataclass(frozen=True)
-class Target:
+class Target(NamedTuple):
     "A compiler target."
     os: str
     arch: str
@@ -21,9 +20,9 @@ class Target:
         return target
 
 
-supported_targets = [
+supported_targets = frozenset([
     Target.from_str("amd64_darwin"),
-]
+])
 
 
-current_target = supported_targets[0]
+current_target = Target.from_str("amd64_darwin")
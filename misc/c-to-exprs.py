@@ -3,6 +3,9 @@
 # dump a pycparser AST as symbolic expressions.
 
 import sys
+import itertools
+import functools
+import operator
 #sys.path.insert(0, '/Users/cell/github/eliben/pycparser/')
 #sys.path.insert(0, '/home/cell/github/eliben/pycparser/')
 from pycparser import parse_file
@@ -14,7 +17,8 @@ def make_exprs(self):
     items = [self.__class__.__name__]
     # add the attributes
     if self.attr_names:
-        for name, value in [(n, getattr(self,n)) for n in self.attr_names]:
+        for (name, getter) in _attr_getters(type(self)):
+            value = getter(self)
             # suppress empty fields
             if value is None:
                 continue
@@ -27,41 +31,56 @@ def make_exprs(self):
                 items.append(str(value))
             continue
     # add the children
-    chdn = self.children()
-    i = 0
-    while i < len(chdn):
-        (name, child) = chdn[i]
-        if name.endswith("[0]"):
-            # this is the start of a 'multiname', e.g. 'block_items[0]'
-            multiname = name.split('[')[0]
-            multiitems = []
-            while i < len(chdn) and chdn[i][0].startswith("%s[" % multiname):
-                multiitems.append(chdn[i][1].make_exprs())
-                i += 1
-            items.append(multiname)
-            items.append(["list", *multiitems])
-            continue
+    # note: children() builds a new tuple on each call, so walk it once,
+    # grouping consecutive children by the part of their name before any '['.
+    for (basename, group) in itertools.groupby(self.children(), key=_child_basename):
+        group = list(group)
+        if group[0][0].endswith("[0]"):
+            # this is a 'multiname', e.g. 'block_items[0]', 'block_items[1]'
+            items.append(basename)
+            items.append(["list", *[child.make_exprs() for (_, child) in group]])
         else:
-            items.append(name)
-            items.append(child.make_exprs())
-            i += 1
-            continue
+            for (name, child) in group:
+                items.append(name)
+                items.append(child.make_exprs())
     return items
 
 
+def _child_basename(name_child):
+    "block_items[0] -> block_items"
+    return name_child[0].partition('[')[0]
+
+
+@functools.cache
+def _attr_getters(cls):
+    "Return the (name, getter) of each of a Node class's attributes."
+    # note: attr_names is fixed per class, so build its getters once.
+    return tuple((name, operator.attrgetter(name)) for name in cls.attr_names)
+
+
 Node.make_exprs = make_exprs
 
 
 def format_exprs(exprs):
     "format the symbolic expressions as a string"
-    strs = []
-    for subexpr in exprs:
+    # note: rather than joining a string at every level of nesting (and then
+    # copying it into its parent's), collect all of the tokens and join once.
+    out = []
+    _format_exprs(exprs, out)
+    return "".join(out)
+
+
+def _format_exprs(exprs, out):
+    "append the tokens of the symbolic expressions to out"
+    out.append("(")
+    for (i, subexpr) in enumerate(exprs):
+        if i > 0:
+            out.append(" ")
         if isinstance(subexpr, str):
-            strs.append(subexpr)
+            out.append(subexpr)
         else:
-            strs.append(format_exprs(subexpr))
-    text = "(%s)" % " ".join(strs)
-    return text
+            _format_exprs(subexpr, out)
+    out.append(")")
 
 
 if __name__ == "__main__":
@@ -4,14 +4,16 @@
 # This is a demonstration of patching in an alternative Node.show() method.
 
 import sys
+import functools
+import operator
 #sys.path.insert(0, '/Users/cell/github/eliben/pycparser/')
 #sys.path.insert(0, '/home/cell/github/eliben/pycparser/')
 from pycparser import parse_file
 from pycparser.c_ast import *
 
-def show(self, buf=sys.stdout, indent=4, showcoord=True, _my_node_name=None, _lead='', _lastcoord=None, _depth=1):
+def show(self, buf=sys.stdout, indent=4, showcoord=True):
     """ Pretty print the Node and all its attributes and
-        children (recursively) to a buffer.
+        children to a buffer.
 
         buf:
             Open IO buffer into which the Node is printed.
@@ -22,68 +24,89 @@ def show(self, buf=sys.stdout, indent=4, showcoord=True, _my_node_name=None, _le
         showcoord:
             Do you want the coordinates of each Node to be
             displayed.
-
-        returns the number of parens which need to be closed by the parent.
     """
-    # print the node type
-    s = _lead
-    if _my_node_name:
-        s += "%s = " % _my_node_name
-    s += "%s(" % (self.__class__.__name__)
-    if showcoord and self.coord:
-        # only print the line number if it has changed
-        coord_did_change = _lastcoord is None \
-            or self.coord.file != _lastcoord.file \
-            or self.coord.line != _lastcoord.line
-        if coord_did_change:
-            s += '  // '
-            if self.coord.file:
-                s += '%s ' % self.coord.file
-            s += 'line %s' % self.coord.line
-            _lastcoord = self.coord
-    buf.write(s + '\n')
-
     # use dots to give visual column cues
-    lead2 = _lead + '.' + (' ' * (indent-1))
-
-    # print the attributes
-    if self.attr_names:
-        for name, value in [(n, getattr(self,n)) for n in self.attr_names]:
-            # suppress empty fields
-            if value is None:
-                continue
-            if hasattr(value, '__len__') and len(value) == 0:
-                continue
-            buf.write(lead2 + "%s = %s\n" % (name, value))
-
-    # print the children.
-    unclosed_depth = 0
-    for i, (child_name, child) in enumerate(self.children()):
-        is_last = i+1 == len(self.children())
-        unclosed_depth = child.show(
-            buf,
-            indent=indent,
-            _my_node_name=child_name,
-            _lead=lead2,
-            _lastcoord=_lastcoord,
-            _depth=_depth+1
-        )
-        if not is_last:
-            dot_spaces = ('.' + ' '*(indent-1))
-            spaces_cparen = ')' + ' ' * (indent-1)
-            buf.write((dot_spaces * _depth) + (spaces_cparen * unclosed_depth) + '\n')
-        else:
-            # let the caller close out parens after the last child
-            pass
-
-    if _depth == 1:
-        # this is the final paren closing
-        unclosed_depth += 1
-        spaces_cparen = ')' + ' ' * (indent-1)
-        buf.write((spaces_cparen * unclosed_depth) + '\n')
-    else:
-        # let the caller close out parens after the last child
-        return unclosed_depth + 1
+    dot_spaces = '.' + ' ' * (indent-1)
+    spaces_cparen = ')' + ' ' * (indent-1)
+    write = buf.write
+
+    # note: rather than recursing once per node, we walk the tree with an
+    # explicit stack, which holds the nodes still to be printed, interleaved
+    # with the work to do after each child:
+    #   (_NODE, node, node_name, lead, lastcoord, depth): print a node.
+    #   (_SEPARATE, depth): close a non-last child's parens.
+    #   (_CLOSE, None): a node's last child is done, so it has one more paren.
+    # 'unclosed' is the number of parens the most recently printed node
+    # left for its parent to close.
+    unclosed = 0
+    stack = [(_NODE, self, None, '', None, 1)]
+    while stack:
+        item = stack.pop()
+        kind = item[0]
+        if kind is _SEPARATE:
+            write((dot_spaces * item[1]) + (spaces_cparen * unclosed) + '\n')
+            continue
+        if kind is _CLOSE:
+            unclosed += 1
+            continue
+        (_, node, node_name, lead, lastcoord, depth) = item
+
+        # print the node type
+        s = lead
+        if node_name:
+            s += "%s = " % node_name
+        s += "%s(" % (node.__class__.__name__)
+        if showcoord and node.coord:
+            # only print the line number if it has changed
+            coord_did_change = lastcoord is None \
+                or node.coord.file != lastcoord.file \
+                or node.coord.line != lastcoord.line
+            if coord_did_change:
+                s += '  // '
+                if node.coord.file:
+                    s += '%s ' % node.coord.file
+                s += 'line %s' % node.coord.line
+                lastcoord = node.coord
+        write(s + '\n')
+
+        lead2 = lead + dot_spaces
+
+        # print the attributes
+        if node.attr_names:
+            for (name, getter) in _attr_getters(type(node)):
+                value = getter(node)
+                # suppress empty fields
+                if value is None:
+                    continue
+                if hasattr(value, '__len__') and len(value) == 0:
+                    continue
+                write(lead2 + "%s = %s\n" % (name, value))
+
+        # queue up the children (in reverse, as this is a stack).
+        children = node.children()
+        if len(children) == 0:
+            unclosed = 1
+            continue
+        stack.append((_CLOSE, None))
+        for (i, (child_name, child)) in enumerate(reversed(children)):
+            if i > 0:
+                stack.append((_SEPARATE, depth))
+            stack.append((_NODE, child, child_name, lead2, lastcoord, depth + 1))
+
+    # this is the final paren closing
+    write((spaces_cparen * unclosed) + '\n')
+
+
+_NODE = "node"
+_SEPARATE = "separate"
+_CLOSE = "close"
+
+
+@functools.cache
+def _attr_getters(cls):
+    "Return the (name, getter) of each of a Node class's attributes."
+    # note: attr_names is fixed per class, so build its getters once.
+    return tuple((name, operator.attrgetter(name)) for name in cls.attr_names)
 
 
 if __name__ == "__main__":